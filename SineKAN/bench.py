@@ -0,0 +1,230 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+
+from config import SkanformerTestConfig
+from constants import SPECIAL_SYMBOLS
+from fn_utils import get_model, parse_ff_dims
+from trainer import Predictor
+
+DTYPES = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+PERCENTILES = (50, 90, 99)
+
+
+def peak_rss_mib():
+    """Peak RSS of the process so far."""
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def peak_memory_mib(device, baseline_mib=0.0):
+    """Peak CUDA memory allocated since the last reset, or peak process RSS above a baseline on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return peak_rss_mib() - baseline_mib
+
+
+class Timer:
+    """Wall-clock timer that waits for queued CUDA work before reading the clock."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+
+def summarize(times, tokens):
+    """Latency percentiles in milliseconds and throughput of one phase."""
+    times = np.asarray(times)
+    summary = {f"p{q}_ms": float(np.percentile(times, q) * 1e3) for q in PERCENTILES}
+    summary['tokens_per_sec'] = float(tokens / times.mean())
+    return summary
+
+
+def build_config(args, ff_dims, grid_size, seq_len):
+    """Test config describing the benchmarked model."""
+    return SkanformerTestConfig(
+        model_name='bench',
+        root_dir='.',
+        data_dir='.',
+        device=args.device,
+        embedding_size=args.embedding_size,
+        nhead=args.nhead,
+        num_layers=args.num_layers,
+        ff_dims=ff_dims,
+        d_ff=args.d_ff,
+        dropout=args.dropout,
+        src_max_len=seq_len,
+        tgt_max_len=seq_len,
+        src_voc_size=args.voc_size,
+        tgt_voc_size=args.voc_size,
+        attention_backend=args.attention_backend,
+        kan_impl=args.kan_impl,
+        grid_size=grid_size,
+    )
+
+
+def bench_case(args, batch_size, seq_len, ff_dims, grid_size, dtype_name):
+    """
+    Benchmark one configuration.
+
+    Returns:
+        dict: Settings and per-phase measurements of the configuration.
+    """
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    # On CPU the case runs in a fresh process, whose peak RSS so far is the cost of the imports
+    baseline_mib = peak_rss_mib()
+    config = build_config(args, ff_dims, grid_size, seq_len)
+    model = get_model(config).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = torch.nn.CrossEntropyLoss()
+    dtype = DTYPES[dtype_name]
+    autocast = (torch.autocast(device_type=device.type, dtype=dtype) if dtype != torch.float32
+                else contextlib.nullcontext())
+
+    generator = torch.Generator().manual_seed(args.seed)
+    low = len(SPECIAL_SYMBOLS)
+    src = torch.randint(low, args.voc_size, (batch_size, seq_len), generator=generator).to(device)
+    tgt = torch.randint(low, args.voc_size, (batch_size, seq_len), generator=generator).to(device)
+    label = torch.randint(low, args.voc_size, (batch_size, seq_len), generator=generator).to(device)
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    timer = Timer(device)
+    phases = {'forward': [], 'backward': [], 'optimizer': [], 'decode': []}
+
+    model.train()
+    for i in range(args.warmup + args.iters):
+        start = timer.now()
+        with autocast:
+            src_mask, tgt_mask = model.make_src_mask(src), model.make_tgt_mask(tgt)
+            logits = model(src, tgt, src_mask, tgt_mask)
+            loss = criterion(logits.reshape(-1, logits.shape[-1]), label.reshape(-1))
+        forward_end = timer.now()
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        backward_end = timer.now()
+        optimizer.step()
+        step_end = timer.now()
+        if i >= args.warmup:
+            phases['forward'].append(forward_end - start)
+            phases['backward'].append(backward_end - forward_end)
+            phases['optimizer'].append(step_end - backward_end)
+
+    predictor = Predictor(config, model=model)
+    predictor.max_len = args.decode_len
+    for i in range(args.decode_warmup + args.decode_iters):
+        start = timer.now()
+        with autocast:
+            predictor.predict_batch(src)
+        if i >= args.decode_warmup:
+            phases['decode'].append(timer.now() - start)
+
+    train_tokens = batch_size * 2 * seq_len
+    result = {
+        'model': 'skanformer', 'device': device.type, 'batch_size': batch_size, 'seq_len': seq_len,
+        'ff_dims': ','.join(map(str, ff_dims)), 'grid_size': grid_size, 'dtype': dtype_name,
+        'peak_memory_mib': peak_memory_mib(device, baseline_mib),
+    }
+    for phase in ('forward', 'backward', 'optimizer'):
+        result.update({f"{phase}_{key}": value for key, value in summarize(phases[phase], train_tokens).items()})
+    train_step = np.sum([phases[phase] for phase in ('forward', 'backward', 'optimizer')], axis=0)
+    result.update({f"train_step_{key}": value for key, value in summarize(train_step, train_tokens).items()})
+    # Decoding always runs the full decode_len steps, a randomly initialised model rarely emits EOS
+    decode_tokens = batch_size * (args.decode_len - 1)
+    result.update({f"decode_{key}": value for key, value in summarize(phases['decode'], decode_tokens).items()})
+    return result
+
+
+def write_results(results, path):
+    """Write results as JSON or CSV, depending on the file extension."""
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(',')]
+
+
+def parse_args():
+    """Parses command-line arguments for the S-KANformer benchmark."""
+    parser = argparse.ArgumentParser(description="Skanformer Throughput/Latency Benchmark")
+
+    # Sweeps
+    parser.add_argument('--batch_sizes', type=parse_list, default=[8], help='Batch sizes (comma-separated)')
+    parser.add_argument('--seq_lens', type=parse_list, default=[64], help='Source/target lengths (comma-separated)')
+    parser.add_argument('--ff_dims', type=lambda value: [parse_ff_dims(dims) for dims in value.split(';')],
+                        default=[[256]], help='KAN layer sizes, sweeps separated by ";" (e.g. "256;512,256")')
+    parser.add_argument('--grid_sizes', type=parse_list, default=[8], help='SineKAN grid sizes (comma-separated)')
+    parser.add_argument('--dtypes', type=lambda value: parse_list(value, str), default=['float32'],
+                        help=f"Autocast dtypes (comma-separated, from {', '.join(DTYPES)})")
+
+    # Model Architecture
+    parser.add_argument('--embedding_size', type=int, default=128, help='Embedding dimensions')
+    parser.add_argument('--nhead', type=int, default=4, help='Transformer attention heads')
+    parser.add_argument('--num_layers', type=int, default=2, help='Number of transformer layers')
+    parser.add_argument('--d_ff', type=int, default=512, help='Feed-forward network dimensions')
+    parser.add_argument('--dropout', type=float, default=0.1, help='Dropout probability')
+    parser.add_argument('--voc_size', type=int, default=1000, help='Source and target vocabulary size')
+    parser.add_argument('--attention_backend', type=str, default='sdpa', choices=['sdpa', 'math'], help='Attention implementation')
+    parser.add_argument('--kan_impl', type=str, default='einsum', choices=['einsum', 'recompute', 'trig'], help='SineKAN layer implementation')
+
+    # Measurement
+    parser.add_argument('--device', type=str, default='cpu', help='Benchmark device')
+    parser.add_argument('--iters', type=int, default=10, help='Timed training iterations')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed training iterations')
+    parser.add_argument('--decode_len', type=int, default=32, help='Decoded sequence length, start symbol included')
+    parser.add_argument('--decode_iters', type=int, default=3, help='Timed decoding runs')
+    parser.add_argument('--decode_warmup', type=int, default=1, help='Untimed decoding runs')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the random inputs')
+    parser.add_argument('--output', type=str, default=None, help='Write results to a .json or .csv file')
+    return parser.parse_args()
+
+
+def run_case(args, *case):
+    """
+    Benchmark one configuration, on CPU in a fresh process.
+
+    The CPU peak memory is read from the process peak RSS, which never goes down, so every
+    case gets a process of its own instead of inheriting the peak of the previous ones.
+    """
+    if torch.device(args.device).type == 'cuda':
+        return bench_case(args, *case)
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(bench_case, (args,) + case)
+
+
+def main(args):
+    results = []
+    for batch_size, seq_len, ff_dims, grid_size, dtype_name in itertools.product(
+            args.batch_sizes, args.seq_lens, args.ff_dims, args.grid_sizes, args.dtypes):
+        result = run_case(args, batch_size, seq_len, ff_dims, grid_size, dtype_name)
+        results.append(result)
+        print(f"bs={batch_size} len={seq_len} ff_dims={result['ff_dims']} grid={grid_size} {dtype_name}: "
+              f"train {result['train_step_tokens_per_sec']:.0f} tok/s (p50 {result['train_step_p50_ms']:.1f} ms), "
+              f"decode {result['decode_tokens_per_sec']:.0f} tok/s (p50 {result['decode_p50_ms']:.1f} ms), "
+              f"peak {result['peak_memory_mib']:.0f} MiB")
+    if args.output:
+        write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parse_args())
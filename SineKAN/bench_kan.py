@@ -0,0 +1,78 @@
+import argparse
+import copy
+import time
+
+import torch
+
+from model import SineKANLayer
+
+
+def saved_activation_bytes(layer, x):
+    """Bytes of the tensors autograd keeps for the backward pass of one forward."""
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        layer(x)
+    return total
+
+
+def time_step(layer, x, iters, warmup):
+    """Median forward and backward time in milliseconds."""
+    fwd_times, bwd_times = [], []
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        y = layer(x)
+        mid = time.perf_counter()
+        y.sum().backward()
+        end = time.perf_counter()
+        if i >= warmup:
+            fwd_times.append(mid - start)
+            bwd_times.append(end - mid)
+        layer.zero_grad(set_to_none=True)
+        x.grad = None
+    fwd_times.sort()
+    bwd_times.sort()
+    return 1e3 * fwd_times[len(fwd_times) // 2], 1e3 * bwd_times[len(bwd_times) // 2]
+
+
+def parse_args():
+    """Parses command-line arguments for the SineKAN layer microbenchmark."""
+    parser = argparse.ArgumentParser(description="SineKAN layer microbenchmark")
+    parser.add_argument('--tokens', type=int, default=4096, help='Number of tokens (batch * seq_len)')
+    parser.add_argument('--input_dim', type=int, default=512, help='Layer input size')
+    parser.add_argument('--output_dim', type=int, default=1024, help='Layer output size')
+    parser.add_argument('--grid_size', type=int, default=8, help='SineKAN grid size')
+    parser.add_argument('--impls', type=str, default='einsum,recompute,trig', help='Implementations (comma-separated)')
+    parser.add_argument('--iters', type=int, default=10, help='Timed iterations')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed warmup iterations')
+    parser.add_argument('--threads', type=int, default=None, help='Torch CPU threads')
+    return parser.parse_args()
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    base = SineKANLayer(args.input_dim, args.output_dim, device='cpu', grid_size=args.grid_size, impl='einsum')
+    x = torch.randn(args.tokens, args.input_dim, requires_grad=True)
+    with torch.no_grad():
+        reference = base(x)
+
+    print(f"{'impl':<10} {'fwd ms':>9} {'bwd ms':>9} {'saved MiB':>10} {'max abs err':>12}")
+    for impl in args.impls.split(','):
+        layer = copy.deepcopy(base)
+        layer.impl = impl
+        with torch.no_grad():
+            err = (layer(x) - reference).abs().max().item()
+        saved = saved_activation_bytes(layer, x) / 2**20
+        fwd_ms, bwd_ms = time_step(layer, x, args.iters, args.warmup)
+        print(f"{impl:<10} {fwd_ms:>9.2f} {bwd_ms:>9.2f} {saved:>10.1f} {err:>12.2e}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
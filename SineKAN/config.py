@@ -59,14 +59,44 @@ class SkanformerConfig:
     update_lr: Optional[float] = None
     end_lr: Optional[float] = 1e-8
     clip_grad_norm: Optional[float] = -1
+    grad_accum_steps: int = 1
+    ddp_bucket_cap_mb: int = 25
+    gradient_as_bucket_view: bool = False
+    zero_optimizer: bool = False
     save_last: Optional[bool] = True
     log_freq: Optional[int] = 50
     test_freq: Optional[int] = 10
+    test_batch_size: Optional[int] = 64
+    beam_width: int = 1
+    length_penalty: float = 1.0
+    early_stopping: bool = True
     truncate: Optional[bool] = False
     debug: Optional[bool] = False
     to_replace: bool = False
     index_pool_size: int = 100
     momentum_pool_size: int = 100
+    vocab_workers: int = 0
+    stream_data: bool = False
+    ingest_chunk_size: int = 100000
+    use_token_cache: bool = False
+    token_cache_dir: Optional[str] = None
+    iterable_data: bool = False
+    shard_size: int = 10000
+    shuffle_buffer: int = 10000
+    save_steps: int = 0
+    resume_step: int = 0
+    bucket_batches: bool = False
+    bucket_size_multiplier: int = 100
+    max_tokens: Optional[int] = None
+    attention_backend: str = 'sdpa'
+    retain_attention: bool = False
+    kan_impl: str = 'einsum'
+    grid_size: int = 8
+    profile: bool = False
+    profile_window: int = 100
+    profile_trace_dir: Optional[str] = None
+    profile_trace_start: int = 10
+    profile_trace_steps: int = 5
 
     def to_dict(self):
         """Convert dataclass to dictionary."""
@@ -121,6 +151,14 @@ class SkanformerTestConfig:
 
     # if debug
     debug: Optional[bool] = False
+
+    # Batch size for sequence accuracy decoding
+    test_batch_size: Optional[int] = 64
+
+    # Beam search (a beam width of 1 decodes greedily)
+    beam_width: int = 1
+    length_penalty: float = 1.0
+    early_stopping: bool = True
     
     #to replace index and momentum
     to_replace: bool = False
@@ -129,5 +167,25 @@ class SkanformerTestConfig:
     index_pool_size : int = 100   
     momentum_pool_size : int = 100
 
+    # Pre-tokenised dataset cache (defaults to root_dir/token_cache)
+    use_token_cache: bool = False
+    token_cache_dir: Optional[str] = None
+
+    # Length-bucketed train/valid batches, padded to their longest sequence
+    bucket_batches: bool = False
+    max_tokens: Optional[int] = None
+
+    # Attention implementation ('sdpa' for fused kernels, 'math' for the reference path)
+    attention_backend: str = 'sdpa'
+
+    # Keep the attention probabilities of the last forward for visualisation, runs the 'math' path
+    retain_attention: bool = False
+
+    # SineKAN layer implementation ('einsum', 'trig', or 'recompute' to trade compute for activation memory)
+    kan_impl: str = 'einsum'
+
+    # SineKAN grid size
+    grid_size: int = 8
+
     def to_dict(self):
         return asdict(self)
\ No newline at end of file
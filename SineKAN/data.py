@@ -1,21 +1,28 @@
-from fn_utils import causal_mask
 from torch.utils.data import Dataset
+import numpy as np
 import torch
+from tqdm import tqdm
 
 from constants import BOS_IDX, PAD_IDX, EOS_IDX
+from token_cache import build_token_caches
 
 class Data(Dataset):
     """
     Custom PyTorch dataset for handling data.
 
     Args:
-        df (DataFrame): DataFrame containing data.
+        df (DataFrame or StreamingCorpus): Data, a StreamingCorpus is only read through token_cache.
+        token_cache (TokenCache, optional): Pre-tokenised ids of the same rows, read instead of tokenizing.
+        dynamic_padding (bool, optional): Return unpadded sequences, to be padded per batch by
+            fn_utils.pad_collate_fn. Defaults to False.
     """
 
-    def __init__(self, df, tokenizer, config, src_vocab, tgt_vocab):
+    def __init__(self, df, tokenizer, config, src_vocab, tgt_vocab, token_cache=None, dynamic_padding=False):
         super(Data, self).__init__()
-        self.tgt_vals = df['sqamp']
-        self.src_vals = df['amp']
+        # Cached splits never read the raw expressions, so the DataFrame columns are not kept
+        self.tgt_vals = df['sqamp'] if token_cache is None else None
+        self.src_vals = df['amp'] if token_cache is None else None
+        self.token_cache = token_cache
         self.tgt_tokenize = tokenizer.tgt_tokenize
         self.src_tokenize = tokenizer.src_tokenize
         self.bos_token = torch.tensor([BOS_IDX], dtype=torch.int64)
@@ -24,6 +31,7 @@ class Data(Dataset):
         self.src_vocab = src_vocab
         self.tgt_vocab = tgt_vocab
         self.config = config
+        self.dynamic_padding = dynamic_padding
 
     def __len__(self):
         """
@@ -32,8 +40,31 @@ class Data(Dataset):
         Returns:
             int: Length of the dataset.
         """
+        if self.token_cache is not None:
+            return len(self.token_cache)
         return len(self.src_vals)
 
+    def lengths(self):
+        """
+        Get the source and target lengths of all samples, special tokens included.
+
+        Lengths are read from the token cache offsets when available, otherwise every
+        sample is tokenized once.
+
+        Returns:
+            ndarray: Array of shape (num_samples, 2) with source and target lengths.
+        """
+        if self.token_cache is not None:
+            src_lengths, tgt_lengths = self.token_cache.lengths()
+        else:
+            src_lengths = np.array([len(self.src_tokenize(src, self.config.seed))
+                                    for src in tqdm(self.src_vals, desc='Measuring lengths')])
+            tgt_lengths = np.array([len(self.tgt_tokenize(tgt)) for tgt in self.tgt_vals])
+        # BOS and EOS around the source, BOS or EOS on the target
+        src_lengths = np.minimum(src_lengths + 2, self.config.src_max_len)
+        tgt_lengths = np.minimum(tgt_lengths + 1, self.config.tgt_max_len)
+        return np.stack([src_lengths, tgt_lengths], axis=1)
+
     def __getitem__(self, idx):
         """
         Get an item from the dataset at the specified index.
@@ -42,12 +73,15 @@ class Data(Dataset):
             idx (int): Index of the item.
 
         Returns:
-            tuple: Tuple containing source and target tensors.
+            tuple: Tuple containing source, target and label tensors. Masks are built by the model.
         """
-        src_tokenized = self.src_tokenize(self.src_vals[idx],self.config.seed)
-        tgt_tokenized = self.tgt_tokenize(self.tgt_vals[idx])
-        src_ids = self.src_vocab(src_tokenized)
-        tgt_ids = self.tgt_vocab(tgt_tokenized)
+        if self.token_cache is not None:
+            src_ids, tgt_ids = self.token_cache.get(idx)
+        else:
+            src_tokenized = self.src_tokenize(self.src_vals[idx],self.config.seed)
+            tgt_tokenized = self.tgt_tokenize(self.tgt_vals[idx])
+            src_ids = self.src_vocab(src_tokenized)
+            tgt_ids = self.tgt_vocab(tgt_tokenized)
 
         enc_num_padding_tokens = self.config.src_max_len - len(src_ids) - 2
         dec_num_padding_tokens = self.config.tgt_max_len - len(tgt_ids) - 1
@@ -61,6 +95,14 @@ class Data(Dataset):
             if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
                 raise ValueError("Sentence is too long")
 
+        if self.dynamic_padding:
+            src_ids = torch.tensor(src_ids, dtype=torch.int64)
+            tgt_ids = torch.tensor(tgt_ids, dtype=torch.int64)
+            src_tensor = torch.cat([self.bos_token, src_ids, self.eos_token])
+            tgt_tensor = torch.cat([self.bos_token, tgt_ids])
+            label = torch.cat([tgt_ids, self.eos_token])
+            return src_tensor, tgt_tensor, label
+
         src_tensor = torch.cat(
             [
                 self.bos_token,
@@ -91,10 +133,7 @@ class Data(Dataset):
             dim=0,
         )
 
-        src_mask = (src_tensor != self.pad_token).unsqueeze(0).unsqueeze(0).int() # (1, 1, seq_len)
-        tgt_mask = (tgt_tensor != self.pad_token).unsqueeze(0).int() & causal_mask(tgt_tensor.size(0)) # (1, seq_len) & (1, seq_len, seq_len),
-
-        return src_tensor, tgt_tensor, label, src_mask, tgt_mask
+        return src_tensor, tgt_tensor, label
 
     @staticmethod
     def get_data(df_train, df_test, df_valid, config, tokenizer, src_vocab,tgt_vocab):
@@ -104,8 +143,18 @@ class Data(Dataset):
         Returns:
             dict: Dictionary containing train, test, and valid datasets.
         """
-        train = Data(df_train, tokenizer, config,src_vocab,tgt_vocab)
-        test = Data(df_test, tokenizer, config,src_vocab,tgt_vocab)
-        valid = Data(df_valid, tokenizer, config,src_vocab,tgt_vocab)
+        caches = {}
+        if config.use_token_cache:
+            caches = build_token_caches({'train': df_train, 'test': df_test, 'valid': df_valid},
+                                        config, tokenizer, src_vocab, tgt_vocab)
+
+        # Bucketed splits are padded per batch, the test split keeps fixed-size examples for decoding
+        dynamic_padding = config.bucket_batches or config.max_tokens is not None
+        train = Data(df_train, tokenizer, config,src_vocab,tgt_vocab, caches.get('train'), dynamic_padding)
+        # Ranks that never evaluate sequence accuracy may not read the test split
+        test = None
+        if df_test is not None or 'test' in caches:
+            test = Data(df_test, tokenizer, config,src_vocab,tgt_vocab, caches.get('test'))
+        valid = Data(df_valid, tokenizer, config,src_vocab,tgt_vocab, caches.get('valid'), dynamic_padding)
 
         return {'train': train, 'test': test, 'valid': valid}
\ No newline at end of file
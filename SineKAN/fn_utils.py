@@ -2,27 +2,146 @@ from config import SkanformerConfig
 from model import build_kanformer
 from tokenizer import Tokenizer
 from prefix_tokenizer import PrefixTokenizer
+from torchtext.vocab import vocab
 import torch.distributed as dist
 import torch
+from torch.nn.utils.rnn import pad_sequence
 import random
 from typing import List
 import argparse
+import hashlib
+import json
+import os
+from collections import OrderedDict
 from datetime import timedelta
 
 from constants import BOS_IDX, PAD_IDX, EOS_IDX, UNK_IDX, SPECIAL_SYMBOLS
+from ingest import StreamingCorpus, iter_chunks
 
 def create_tokenizer(df, config, index_pool_size, momentum_pool_size):
-    """Create a tokenizer and build source and target vocabularies."""
-    
-    tokenizer = Tokenizer(df, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX, config.to_replace)
+    """
+    Create a tokenizer and source and target vocabularies.
+
+    Vocabularies are persisted next to the checkpoints and reused as long as the data
+    and tokenizer settings they were built from are unchanged.
+    """
     
-    src_vocab = tokenizer.build_src_vocab(config.seed)
+    streaming = isinstance(df, StreamingCorpus)
+    tokenizer = Tokenizer(None if streaming else df, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX,
+                          config.to_replace)
+
+    settings = tokenizer_settings(config, index_pool_size, momentum_pool_size)
+    key = content_hash(df, settings)
+    vocab_path = os.path.join(config.root_dir, f"{config.model_name}_vocab.json")
+    vocabs = load_vocab(vocab_path, key)
+    if vocabs is not None:
+        src_vocab, tgt_vocab = vocabs
+        print(f"Loaded vocabularies from {vocab_path}")
+    elif streaming:
+        # One pass over the files counts both sides, chunk by chunk
+        src_counter, tgt_counter = tokenizer.count_chunk_tokens(df.chunks(), config.seed, config.vocab_workers)
+        src_vocab, tgt_vocab = tokenizer.vocab_from_counter(src_counter), tokenizer.vocab_from_counter(tgt_counter)
+        save_vocab(vocab_path, key, settings, src_vocab, tgt_vocab)
+    else:
+        src_vocab = tokenizer.build_src_vocab(config.seed, config.vocab_workers)
+        tgt_vocab = tokenizer.build_tgt_vocab(config.vocab_workers)
+        save_vocab(vocab_path, key, settings, src_vocab, tgt_vocab)
+
     src_itos = {value: key for key, value in src_vocab.get_stoi().items()}
-    tgt_vocab = tokenizer.build_tgt_vocab()
     tgt_itos = {value: key for key, value in tgt_vocab.get_stoi().items()}
 
     return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
 
+def create_shared_tokenizer(df, config, index_pool_size, momentum_pool_size):
+    """
+    Create the tokenizer and vocabularies on the first rank and share them with the others.
+
+    Only the first rank needs the concatenated DataFrame; the other ranks may pass None and
+    receive the vocabularies through an object broadcast instead of re-tokenizing the corpus.
+    """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return create_tokenizer(df, config, index_pool_size, momentum_pool_size)
+
+    # Object collectives pickle through CPU tensors, so they run on a gloo group
+    group = dist.new_group(backend='gloo')
+    rank = dist.get_rank()
+    if rank == 0:
+        tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos = create_tokenizer(df, config, index_pool_size,
+                                                                               momentum_pool_size)
+        payload = [src_vocab.get_itos(), tgt_vocab.get_itos()]
+    else:
+        payload = [None, None]
+    dist.broadcast_object_list(payload, src=0, group=group)
+    dist.destroy_process_group(group)
+
+    if rank == 0:
+        return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
+
+    tokenizer = Tokenizer(None, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX, config.to_replace)
+    src_vocab, tgt_vocab = vocab_from_itos(payload[0]), vocab_from_itos(payload[1])
+    src_itos = dict(enumerate(payload[0]))
+    tgt_itos = dict(enumerate(payload[1]))
+    return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
+
+def tokenizer_settings(config, index_pool_size, momentum_pool_size):
+    """Settings that determine the token stream of an expression."""
+    return {
+        'to_replace': config.to_replace,
+        'index_pool_size': index_pool_size,
+        'momentum_pool_size': momentum_pool_size,
+        'seed': config.seed,
+        'special_symbols': SPECIAL_SYMBOLS,
+    }
+
+def content_hash(df, settings, vocabs=()):
+    """
+    Hash the expressions of a DataFrame together with the settings and vocabularies derived from them.
+
+    A StreamingCorpus is read one column at a time and hashes like the DataFrame of its rows.
+    """
+    digest = hashlib.sha256()
+    for column in ('amp', 'sqamp'):
+        for chunk in iter_chunks(df, (column,)):
+            for expr in chunk[column]:
+                digest.update(expr.encode())
+                digest.update(b'\0')
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    for voc in vocabs:
+        digest.update('\0'.join(voc.get_itos()).encode())
+        digest.update(b'\1')
+    return digest.hexdigest()[:16]
+
+def vocab_from_itos(itos):
+    """Rebuild a vocabulary from its index-to-token list."""
+    voc = vocab(OrderedDict((token, 1) for token in itos))
+    voc.set_default_index(UNK_IDX)
+    return voc
+
+def save_vocab(path, key, settings, src_vocab, tgt_vocab):
+    """Persist vocabularies and the tokenizer settings they were built with."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    artifacts = {
+        'hash': key,
+        'tokenizer': settings,
+        'src_itos': src_vocab.get_itos(),
+        'tgt_itos': tgt_vocab.get_itos(),
+    }
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(artifacts, f)
+    os.replace(tmp_path, path)
+
+def load_vocab(path, key):
+    """Load persisted vocabularies, or return None if they are missing or stale."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        artifacts = json.load(f)
+    if artifacts['hash'] != key:
+        print(f"Vocabularies in {path} are stale, rebuilding")
+        return None
+    return vocab_from_itos(artifacts['src_itos']), vocab_from_itos(artifacts['tgt_itos'])
+
 def init_distributed_mode(config):
     """Initialize the distributed processing mode."""
     dist.init_process_group(backend=config.backend, timeout=timedelta(minutes=30))
@@ -37,10 +156,21 @@ def decode_sequence(src: List[int], itos):
     """Decode a sequence of token indices into a string."""
     return ''.join(itos[y] for y in src if y not in {PAD_IDX, BOS_IDX, EOS_IDX})
 
-def causal_mask(size):
-    """Create a causal mask for a sequence of given size."""
-    mask = torch.triu(torch.ones((1, size, size)), diagonal=1).int()
-    return mask == 0
+def pad_collate_fn(batch):
+    """
+    Pad a batch of unpadded samples to its longest sequences.
+
+    Args:
+        batch (list): Source, target and label tensors of every sample.
+
+    Returns:
+        tuple: Padded source, target and label batches.
+    """
+    src, tgt, label = zip(*batch)
+    src = pad_sequence(src, batch_first=True, padding_value=PAD_IDX)
+    tgt = pad_sequence(tgt, batch_first=True, padding_value=PAD_IDX)
+    label = pad_sequence(label, batch_first=True, padding_value=PAD_IDX)
+    return src, tgt, label
 
 def calculate_line_params(point1, point2):
     """Calculate the slope and intercept of a line given two points."""
@@ -65,7 +195,9 @@ def get_model(config):
     """
     model = build_kanformer(config.src_voc_size, config.tgt_voc_size,config.src_max_len,config.tgt_max_len, 
                             config.embedding_size, config.num_layers, 
-                            config.nhead,config.dropout,config.d_ff,config.ff_dims,config.device)
+                            config.nhead,config.dropout,config.d_ff,config.ff_dims,config.device,
+                            config.attention_backend, retain_attention=config.retain_attention,
+                            kan_impl=config.kan_impl, grid_size=config.grid_size)
 
     return model
 
@@ -130,15 +262,45 @@ def parse_args():
     parser.add_argument('--update_lr', type=float, default=None, help='Updated learning rate')
     parser.add_argument('--end_lr', type=float, default=1e-8, help='Final/Minimum learning rate while linear decay')
     parser.add_argument('--clip_grad_norm', type=float, default=-1, help='Max gradient norm (disable with -1)')
+    parser.add_argument('--grad_accum_steps', type=int, default=1, help='Micro-batches accumulated per optimizer step')
+    parser.add_argument('--ddp_bucket_cap_mb', type=int, default=25, help='DDP gradient bucket size in MiB')
+    parser.add_argument('--gradient_as_bucket_view', type=bool, default=False, help='Let gradients alias the DDP buckets instead of copying them')
+    parser.add_argument('--zero_optimizer', type=bool, default=False, help='Shard the optimizer state across ranks (ZeRO-1)')
     parser.add_argument('--save_last', type=bool, default=False, help='Save final model checkpoint')
     parser.add_argument('--log_freq', type=int, default=50, help='Logging frequency (steps)')
     parser.add_argument('--test_freq', type=int, default=10, help='Testing frequency (epochs)')
+    parser.add_argument('--test_batch_size', type=int, default=64, help='Batch size (sequence accuracy decoding)')
+    parser.add_argument('--beam_width', type=int, default=1, help='Beam width for decoding (1 for greedy)')
+    parser.add_argument('--length_penalty', type=float, default=1.0, help='Length normalisation exponent for beam search')
+    parser.add_argument('--early_stopping', type=bool, default=True, help='Stop an example once its best finished hypothesis outscores its live beams')
     parser.add_argument('--save_limit', type=int, default=5, help='Max number of saved checkpoints')
     parser.add_argument('--truncate', type=bool, default=False, help='Enable sequence truncation')
     parser.add_argument('--debug', type=bool, default=False, help='Enable debug mode')
     parser.add_argument('--to_replace', type=bool, default=False, help='Replace index/momentum terms')
     parser.add_argument('--index_pool_size', type=int, default=100, help='Index token pool size')
     parser.add_argument('--momentum_pool_size', type=int, default=100, help='Momentum token pool size')
+    parser.add_argument('--vocab_workers', type=int, default=0, help='Processes building the vocabularies (0: all cores)')
+    parser.add_argument('--stream_data', type=bool, default=False, help='Read the splits chunk by chunk instead of into memory (implies use_token_cache)')
+    parser.add_argument('--ingest_chunk_size', type=int, default=100000, help='Rows per chunk when streaming the splits')
+    parser.add_argument('--use_token_cache', type=bool, default=False, help='Read pre-tokenised ids from a memory-mapped cache')
+    parser.add_argument('--token_cache_dir', type=str, default=None, help='Token cache directory (default: root_dir/token_cache)')
+    parser.add_argument('--iterable_data', type=bool, default=False, help='Stream train batches from token cache shards of each (rank, worker) pair (implies stream_data)')
+    parser.add_argument('--shard_size', type=int, default=10000, help='Samples per token cache shard with iterable_data')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000, help='Samples in the shuffle buffer with iterable_data')
+    parser.add_argument('--save_steps', type=int, default=0, help='Save a resumable mid-epoch checkpoint every N optimizer steps (0: off)')
+    parser.add_argument('--resume_step', type=int, default=0, help='Resume from the mid-epoch checkpoint saved at this step')
+    parser.add_argument('--bucket_batches', type=bool, default=False, help='Batch sequences of similar length with dynamic padding')
+    parser.add_argument('--bucket_size_multiplier', type=int, default=100, help='Length bucket size in batches')
+    parser.add_argument('--max_tokens', type=int, default=None, help='Token budget per batch, replaces the batch sizes')
+    parser.add_argument('--attention_backend', type=str, default='sdpa', choices=['sdpa', 'math'], help='Attention implementation')
+    parser.add_argument('--retain_attention', type=bool, default=False, help='Keep attention probabilities for visualisation (math path)')
+    parser.add_argument('--kan_impl', type=str, default='einsum', choices=['einsum', 'recompute', 'trig'], help='SineKAN layer implementation')
+    parser.add_argument('--grid_size', type=int, default=8, help='SineKAN grid size')
+    parser.add_argument('--profile', type=bool, default=False, help='Time data loading, forward, backward and optimizer phases')
+    parser.add_argument('--profile_window', type=int, default=100, help='Steps the profiled percentiles are taken over')
+    parser.add_argument('--profile_trace_dir', type=str, default=None, help='Write a torch.profiler trace to this directory')
+    parser.add_argument('--profile_trace_start', type=int, default=10, help='First traced step')
+    parser.add_argument('--profile_trace_steps', type=int, default=5, help='Number of traced steps')
 
     return parser.parse_args()
 
@@ -181,14 +343,44 @@ def create_config_from_args(args):
         save_freq=args.save_freq,
         save_limit=args.save_limit,
         test_freq = args.test_freq,
+        test_batch_size=args.test_batch_size,
+        beam_width=args.beam_width,
+        length_penalty=args.length_penalty,
+        early_stopping=args.early_stopping,
         seed=args.seed,
         update_lr=args.update_lr,
         end_lr=args.end_lr,
         clip_grad_norm=args.clip_grad_norm,
+        grad_accum_steps=args.grad_accum_steps,
+        ddp_bucket_cap_mb=args.ddp_bucket_cap_mb,
+        gradient_as_bucket_view=args.gradient_as_bucket_view,
+        zero_optimizer=args.zero_optimizer,
         save_last=args.save_last,
         log_freq=args.log_freq,
         debug=args.debug,
         to_replace=args.to_replace,
         index_pool_size=args.index_pool_size,
-        momentum_pool_size=args.momentum_pool_size
+        momentum_pool_size=args.momentum_pool_size,
+        vocab_workers=args.vocab_workers,
+        stream_data=args.stream_data,
+        ingest_chunk_size=args.ingest_chunk_size,
+        use_token_cache=args.use_token_cache,
+        token_cache_dir=args.token_cache_dir,
+        iterable_data=args.iterable_data,
+        shard_size=args.shard_size,
+        shuffle_buffer=args.shuffle_buffer,
+        save_steps=args.save_steps,
+        resume_step=args.resume_step,
+        bucket_batches=args.bucket_batches,
+        bucket_size_multiplier=args.bucket_size_multiplier,
+        max_tokens=args.max_tokens,
+        attention_backend=args.attention_backend,
+        retain_attention=args.retain_attention,
+        kan_impl=args.kan_impl,
+        grid_size=args.grid_size,
+        profile=args.profile,
+        profile_window=args.profile_window,
+        profile_trace_dir=args.profile_trace_dir,
+        profile_trace_start=args.profile_trace_start,
+        profile_trace_steps=args.profile_trace_steps
     )
@@ -0,0 +1,126 @@
+import os
+
+import pandas as pd
+
+# Columns the models read, every other column is skipped while reading
+COLUMNS = ('amp', 'sqamp')
+# Looked up in this order next to each other, e.g. data_dir + "train.parquet"
+EXTENSIONS = ('.parquet', '.arrow', '.feather', '.csv')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Reading Parquet or Arrow files requires pyarrow (pip install pyarrow)") from error
+    return pyarrow
+
+
+def find_split(data_dir, split):
+    """
+    Path of a dataset split.
+
+    Args:
+        data_dir (str): Prefix of the split files, joined with the split name as in data_dir + "train.csv".
+        split (str): Name of the split.
+
+    Returns:
+        str: Path of the first existing file among the supported formats.
+    """
+    for extension in EXTENSIONS:
+        path = f"{data_dir}{split}{extension}"
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No {split} split found for {data_dir!r} (tried {', '.join(EXTENSIONS)})")
+
+
+def read_chunks(path, chunk_size=100_000, columns=COLUMNS):
+    """
+    Read a CSV, Parquet or Arrow file chunk by chunk.
+
+    Args:
+        path (str): File to read.
+        chunk_size (int, optional): Rows per chunk. Defaults to 100000.
+        columns (tuple, optional): Columns to read. Defaults to ('amp', 'sqamp').
+
+    Yields:
+        DataFrame: Consecutive rows of the file, with only the requested columns.
+    """
+    columns = list(columns)
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+        return
+
+    pa = _import_pyarrow()
+    if path.endswith('.parquet'):
+        parquet_file = pa.parquet.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+        return
+
+    # Arrow IPC files, which Feather v2 files also are
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(columns)
+            for start in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(start, chunk_size).to_pandas()
+
+
+def load_split(data_dir, split):
+    """
+    Read a whole dataset split into memory.
+
+    Returns:
+        DataFrame: The 'amp' and 'sqamp' columns of the split.
+    """
+    path = find_split(data_dir, split)
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=list(COLUMNS))
+    return pd.concat(read_chunks(path), ignore_index=True)
+
+
+class StreamingCorpus:
+    """
+    Expressions of one or more files, read chunk by chunk every time they are iterated.
+
+    Used in place of a DataFrame where the corpus is only ever scanned, e.g. to build
+    vocabularies, hash the data or fill the token cache, so that it never has to fit in memory.
+
+    Args:
+        paths (list): Files in corpus order.
+        chunk_size (int, optional): Rows per chunk. Defaults to 100000.
+    """
+
+    def __init__(self, paths, chunk_size=100_000):
+        self.paths = list(paths)
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_splits(cls, data_dir, splits, chunk_size=100_000):
+        """Corpus of the given splits, in order."""
+        return cls([find_split(data_dir, split) for split in splits], chunk_size)
+
+    def chunks(self, columns=COLUMNS):
+        """Yield DataFrame chunks of all files in order."""
+        for path in self.paths:
+            yield from read_chunks(path, self.chunk_size, columns)
+
+    def __repr__(self):
+        return f"StreamingCorpus({self.paths})"
+
+
+def iter_chunks(data, columns=COLUMNS):
+    """
+    Yield a DataFrame as a single chunk, or the chunks of a StreamingCorpus.
+
+    Args:
+        data (DataFrame or StreamingCorpus): Expressions to scan.
+        columns (tuple, optional): Columns needed. Defaults to ('amp', 'sqamp').
+    """
+    if isinstance(data, StreamingCorpus):
+        yield from data.chunks(columns)
+    else:
+        yield data
@@ -3,17 +3,102 @@ from typing import List, Union
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 from torch.nn import Transformer
 
+from constants import PAD_IDX
+
 
 def forward_step(i_n, grid_size, A, K, C):
     ratio = A * grid_size**(-K) + C
     i_n1 = ratio * i_n
     return i_n1
 
+class SineKANFunction(torch.autograd.Function):
+    """
+    Sine basis expansion and amplitude contraction of a SineKAN layer, evaluated in chunks
+    of tokens.
+
+    Only one chunk of the (tokens, input_dim, grid_size) sine tensor exists at a time, and
+    backward recomputes the sines and cosines from the input instead of storing them.
+    Backward runs under the autocast state of the forward, on whichever device it ran.
+    """
+
+    @staticmethod
+    def forward(ctx, x, freq, phase, amplitudes, chunk_size):
+        # x: (tokens, input_dim), amplitudes: (output_dim, input_dim, grid_size)
+        ctx.save_for_backward(x, freq, phase, amplitudes)
+        ctx.chunk_size = chunk_size
+        ctx.device_type = x.device.type
+        ctx.autocast = torch.is_autocast_enabled(ctx.device_type)
+        ctx.autocast_dtype = torch.get_autocast_dtype(ctx.device_type)
+        input_dim, grid_size = amplitudes.shape[1:]
+        freq = freq.reshape(1, 1, grid_size)
+        phase = phase.reshape(1, input_dim, grid_size)
+        weight = amplitudes.reshape(amplitudes.shape[0], -1)
+        out = []
+        for start in range(0, x.shape[0], chunk_size):
+            s = torch.sin(x[start:start + chunk_size].unsqueeze(-1) * freq + phase)
+            out.append(s.flatten(1) @ weight.t())
+        return torch.cat(out)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):
+        with torch.autocast(ctx.device_type, dtype=ctx.autocast_dtype, enabled=ctx.autocast):
+            return SineKANFunction._backward(ctx, grad_out)
+
+    @staticmethod
+    def _backward(ctx, grad_out):
+        x, freq_param, phase_buf, amplitudes = ctx.saved_tensors
+        # Under autocast the output, and so its gradient, is in the autocast dtype
+        grad_out = grad_out.to(amplitudes.dtype)
+        chunk_size = ctx.chunk_size
+        input_dim, grid_size = amplitudes.shape[1:]
+        freq = freq_param.reshape(1, 1, grid_size)
+        phase = phase_buf.reshape(1, input_dim, grid_size)
+        weight = amplitudes.reshape(amplitudes.shape[0], -1)
+        needs_x, needs_freq, needs_phase, needs_amplitudes, _ = ctx.needs_input_grad
+
+        grad_x = torch.empty_like(x) if needs_x else None
+        grad_freq = torch.zeros(grid_size, dtype=freq.dtype, device=freq.device) if needs_freq else None
+        grad_phase = torch.zeros(input_dim, grid_size, dtype=phase.dtype, device=phase.device) if needs_phase else None
+        grad_weight = torch.zeros_like(weight) if needs_amplitudes else None
+
+        for start in range(0, x.shape[0], chunk_size):
+            x_chunk = x[start:start + chunk_size].unsqueeze(-1)
+            grad_chunk = grad_out[start:start + chunk_size]
+            arg = x_chunk * freq + phase
+            if needs_amplitudes:
+                grad_weight += grad_chunk.t() @ torch.sin(arg).flatten(1)
+            if needs_x or needs_freq or needs_phase:
+                grad_arg = (grad_chunk @ weight).view_as(arg) * torch.cos(arg)
+                if needs_x:
+                    grad_x[start:start + chunk_size] = (grad_arg * freq).sum(-1)
+                if needs_freq:
+                    grad_freq += (grad_arg * x_chunk).sum((0, 1))
+                if needs_phase:
+                    grad_phase += grad_arg.sum(0)
+
+        return (grad_x,
+                grad_freq.view_as(freq_param) if needs_freq else None,
+                grad_phase.view_as(phase_buf) if needs_phase else None,
+                grad_weight.view_as(amplitudes) if needs_amplitudes else None,
+                None)
+
 class SineKANLayer(torch.nn.Module):
-    def __init__(self, input_dim, output_dim, device='cuda', grid_size=8, is_first=False, add_bias=True, norm_freq=True):
+    # 'einsum' materialises the full sine tensor, 'recompute' evaluates SineKANFunction in token chunks,
+    # and 'trig' expands sin(f x + p) = sin(f x) cos(p) + cos(f x) sin(p) into two dense matmuls
+    IMPLS = ('einsum', 'recompute', 'trig')
+
+    def __init__(self, input_dim, output_dim, device='cuda', grid_size=8, is_first=False, add_bias=True, norm_freq=True,
+                 impl='einsum', chunk_size=1024):
         super(SineKANLayer,self).__init__()
+        if impl not in self.IMPLS:
+            raise ValueError(f"Unknown SineKAN implementation '{impl}', expected one of {self.IMPLS}")
+        self.impl = impl
+        self.chunk_size = chunk_size
         self.grid_size = grid_size
         self.device = device
         self.is_first = is_first
@@ -51,22 +136,35 @@ class SineKANLayer(torch.nn.Module):
         x_shape = x.shape
         output_shape = x_shape[0:-1] + (self.output_dim,)
         x = torch.reshape(x, (-1, self.input_dim))
-        x_reshaped = torch.reshape(x, (x.shape[0], 1, x.shape[1], 1))
-        s = torch.sin(x_reshaped * self.freq + self.phase)
-        y = torch.einsum('ijkl,jkl->ij', s, self.amplitudes)
+        if self.impl == 'recompute':
+            y = SineKANFunction.apply(x, self.freq, self.phase, self.amplitudes, self.chunk_size)
+        elif self.impl == 'trig':
+            y = self._trig_forward(x)
+        else:
+            x_reshaped = torch.reshape(x, (x.shape[0], 1, x.shape[1], 1))
+            s = torch.sin(x_reshaped * self.freq + self.phase)
+            y = torch.einsum('ijkl,jkl->ij', s, self.amplitudes)
         if self.add_bias:
             y += self.bias
         y = torch.reshape(y, output_shape)
         return y
 
+    def _trig_forward(self, x):
+        # The phases only enter the weights: sin(f x) @ (A cos p)^T + cos(f x) @ (A sin p)^T
+        phase = self.phase.reshape(self.input_dim, self.grid_size)
+        weight_sin = (self.amplitudes * torch.cos(phase)).reshape(self.output_dim, -1)
+        weight_cos = (self.amplitudes * torch.sin(phase)).reshape(self.output_dim, -1)
+        xf = x.unsqueeze(-1) * self.freq.reshape(1, 1, self.grid_size)
+        return torch.addmm(torch.sin(xf).flatten(1) @ weight_sin.t(), torch.cos(xf).flatten(1), weight_cos.t())
+
 class KANFeedForwardBlock(nn.Module):
-    def __init__(self, in_size: int, ff_dims: List[int], grid_size: int = 8, device: Union[str, int] = 'cuda') -> None:
+    def __init__(self, in_size: int, ff_dims: List[int], grid_size: int = 8, device: Union[str, int] = 'cuda', impl: str = 'einsum') -> None:
         super().__init__()
         self.ffn = torch.nn.ModuleList()
         for i,d in enumerate(ff_dims):
             self.ffn.append(SineKANLayer(
                 # in_size, d, grid_size=grid_size, device=device, is_first=(i == 0)))
-                in_size, d, grid_size=grid_size, device=device, is_first=False))
+                in_size, d, grid_size=grid_size, device=device, is_first=False, impl=impl))
             in_size = d
         
     def forward(self, x):
@@ -139,8 +237,9 @@ class PositionalEncoding(nn.Module):
         # Register the positional encoding as a buffer
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
+    def forward(self, x, start: int = 0):
+        # start offsets the positions when decoding incrementally one token at a time
+        x = x + (self.pe[:, start:start + x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
         return self.dropout(x)
 
 class ResidualConnection(nn.Module):
@@ -155,8 +254,17 @@ class ResidualConnection(nn.Module):
 
 class MultiHeadAttentionBlock(nn.Module):
 
-    def __init__(self, d_model: int, h: int, dropout: float) -> None:
+    BACKENDS = ('sdpa', 'math')
+
+    def __init__(self, d_model: int, h: int, dropout: float, backend: str = 'sdpa', retain_attention: bool = False) -> None:
         super().__init__()
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown attention backend '{backend}', expected one of {self.BACKENDS}")
+        # 'sdpa' dispatches to fused flash/memory-efficient kernels where available, 'math' is the reference path
+        self.backend = backend
+        # Keeping the probabilities for visualisation needs the math path and O(L^2) memory per layer
+        self.retain_attention = retain_attention
+        self.attention_scores = None
         self.d_model = d_model # Embedding vector size
         self.h = h # Number of heads
         # Make sure d_model is divisible by h
@@ -185,18 +293,45 @@ class MultiHeadAttentionBlock(nn.Module):
         # return attention scores which can be used for visualization
         return (attention_scores @ value), attention_scores
 
-    def forward(self, q, k, v, mask):
+    def forward(self, q, k, v, mask, cache=None, static_kv=False, beams=1):
         query = self.w_q(q) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        key = self.w_k(k) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        value = self.w_v(v) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-
         # (batch, seq_len, d_model) --> (batch, seq_len, h, d_k) --> (batch, h, seq_len, d_k)
         query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+
+        if cache is not None and static_kv and 'key' in cache:
+            # Keys and values of a static input (encoder output) are projected only once
+            key, value = cache['key'], cache['value']
+        else:
+            key = self.w_k(k) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
+            value = self.w_v(v) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
+            key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
+            value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+            if cache is not None:
+                if not static_kv and 'key' in cache:
+                    # Append the new positions to the keys and values of the previous steps
+                    key = torch.cat([cache['key'], key], dim=2)
+                    value = torch.cat([cache['value'], value], dim=2)
+                cache['key'], cache['value'] = key, value
+
+        # Beams of an example share the keys and values of its encoder output: their queries are
+        # folded into the query length, (batch * beams, h, q_len, d_k) --> (batch, h, beams * q_len, d_k)
+        assert query.shape[0] == beams * key.shape[0], \
+            f"{query.shape[0]} queries do not match {beams} beams of {key.shape[0]} keys"
+        if beams > 1:
+            q_len = query.shape[2]
+            query = query.view(key.shape[0], beams, self.h, q_len, self.d_k).transpose(1, 2).reshape(key.shape[0], self.h, beams * q_len, self.d_k)
 
         # Calculate attention
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if self.backend == 'sdpa' and not self.retain_attention:
+            # SDPA attends where a boolean mask is True, i.e. where the int masks are non-zero
+            attn_mask = mask if mask is None or mask.dtype == torch.bool else mask != 0
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask,
+                                               dropout_p=self.dropout.p if self.training else 0.0)
+        else:
+            x, attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+            self.attention_scores = attention_scores if self.retain_attention else None
+        if beams > 1:
+            x = x.view(key.shape[0], self.h, beams, q_len, self.d_k).transpose(1, 2).reshape(-1, self.h, q_len, self.d_k)
         
         # Combine all the heads together
         # (batch, h, seq_len, d_k) --> (batch, seq_len, h, d_k) --> (batch, seq_len, d_model)
@@ -242,9 +377,12 @@ class DecoderBlock(nn.Module):
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(2)]) if is_kan else nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
         self.is_kan = is_kan
 
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None):
+        self_cache = cache['self'] if cache is not None else None
+        cross_cache = cache['cross'] if cache is not None else None
+        beams = cache['beams'] if cache is not None else 1
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask, self_cache))
+        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask, cross_cache, static_kv=True, beams=beams))
         if self.is_kan:
             x = self.ff_block(x)
         else:
@@ -258,9 +396,9 @@ class Decoder(nn.Module):
         self.layers = layers
         self.norm = LayerNormalization(features)
 
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None):
+        for i, layer in enumerate(self.layers):
+            x = layer(x, encoder_output, src_mask, tgt_mask, cache[i] if cache is not None else None)
         return self.norm(x)
 
 class ProjectionLayer(nn.Module):
@@ -275,7 +413,7 @@ class ProjectionLayer(nn.Module):
     
 class Transformer(nn.Module):
 
-    def __init__(self, encoder: Encoder, decoder: Decoder, src_embed: InputEmbeddings, tgt_embed: InputEmbeddings, src_pos: PositionalEncoding, tgt_pos: PositionalEncoding, projection_layer: ProjectionLayer) -> None:
+    def __init__(self, encoder: Encoder, decoder: Decoder, src_embed: InputEmbeddings, tgt_embed: InputEmbeddings, src_pos: PositionalEncoding, tgt_pos: PositionalEncoding, projection_layer: ProjectionLayer, tgt_seq_len: int) -> None:
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
@@ -284,6 +422,18 @@ class Transformer(nn.Module):
         self.src_pos = src_pos
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
+        # One causal mask for the longest target, sliced per batch and kept out of checkpoints
+        causal_mask = torch.tril(torch.ones(tgt_seq_len, tgt_seq_len, dtype=torch.bool))
+        self.register_buffer('causal_mask', causal_mask, persistent=False)
+
+    def make_src_mask(self, src):
+        # (batch, seq_len) --> (batch, 1, 1, seq_len), broadcast over heads and queries
+        return (src != PAD_IDX).unsqueeze(1).unsqueeze(1)
+
+    def make_tgt_mask(self, tgt):
+        # (batch, 1, 1, seq_len) & (seq_len, seq_len) --> (batch, 1, seq_len, seq_len)
+        seq_len = tgt.size(1)
+        return (tgt != PAD_IDX).unsqueeze(1).unsqueeze(1) & self.causal_mask[:seq_len, :seq_len]
 
     def encode(self, src, src_mask):
         # (batch, seq_len, d_model)
@@ -291,18 +441,38 @@ class Transformer(nn.Module):
         src = self.src_pos(src)
         return self.encoder(src, src_mask)
     
-    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
+    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor, cache=None):
+        # With a cache, tgt holds only the new tokens and tgt_mask may be None
+        start = cache[0]['self']['key'].shape[2] if cache is not None and 'key' in cache[0]['self'] else 0
         # (batch, seq_len, d_model)
         tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        tgt = self.tgt_pos(tgt, start)
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache)
+
+    def init_decoder_cache(self, beams=1):
+        # Per-layer key/value caches for incremental decoding. With beams, the target batch holds
+        # beams consecutive rows per row of the encoder output, which they attend to in common
+        return [{'self': {}, 'cross': {}, 'beams': beams} for _ in self.decoder.layers]
+
+    def reorder_decoder_cache(self, cache, beam_idx):
+        # Beams never leave their example, so only the self-attention caches need reordering
+        for layer_cache in cache:
+            for name in ('key', 'value'):
+                layer_cache['self'][name] = layer_cache['self'][name].index_select(0, beam_idx)
     
     def project(self, x):
         # (batch, seq_len, vocab_size)
         return self.projection_layer(x)
+
+    def forward(self, src, tgt, src_mask, tgt_mask):
+        # Teacher-forced pass used for training, (batch, tgt_len, vocab_size)
+        encoder_output = self.encode(src, src_mask)
+        return self.project(self.decode(encoder_output, src_mask, tgt, tgt_mask))
     
 def build_kanformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, 
-                      N: int=3, h: int=8, dropout: float=0.1, d_ff: int=4096, ff_dims: List[int]=[8192], device: Union[str, int] = 'cuda') -> Transformer:
+                      N: int=3, h: int=8, dropout: float=0.1, d_ff: int=4096, ff_dims: List[int]=[8192], device: Union[str, int] = 'cuda',
+                      attention_backend: str = 'sdpa', retain_attention: bool = False, kan_impl: str = 'einsum',
+                      grid_size: int = 8) -> Transformer:
     # Create the embedding layers
     src_embed = InputEmbeddings(d_model, src_vocab_size)
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
@@ -314,7 +484,7 @@ def build_kanformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int,
     # Create the encoder blocks
     encoder_blocks = []
     for _ in range(N):
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, retain_attention)
         ff_block = FeedForwardBlock(d_model,d_ff,dropout)
         encoder_block = EncoderBlock(d_model, encoder_self_attention_block, ff_block, dropout)
         encoder_blocks.append(encoder_block)
@@ -322,10 +492,10 @@ def build_kanformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int,
     # Create the decoder blocks
     decoder_blocks = []
     for i in range(N):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, retain_attention)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, retain_attention)
         ff_block = FeedForwardBlock(d_model,d_ff,dropout)
-        kan_block = KANFeedForwardBlock(d_model,ff_dims,device=device)
+        kan_block = KANFeedForwardBlock(d_model,ff_dims,grid_size=grid_size,device=device,impl=kan_impl)
         if i == N-1:
             decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, kan_block, dropout, is_kan=True)
         else:
@@ -341,7 +511,7 @@ def build_kanformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int,
     projection_layer = ProjectionLayer(ff_dims[-1], tgt_vocab_size)
     
     # Create the transformer
-    transformer = Transformer(encoder, decoder, src_embed, tgt_embed, src_pos, tgt_pos, projection_layer)
+    transformer = Transformer(encoder, decoder, src_embed, tgt_embed, src_pos, tgt_pos, projection_layer, tgt_seq_len)
     
     # Initialize the parameters
     for _,p in transformer.named_parameters():
@@ -0,0 +1,112 @@
+import copy
+
+import pytest
+import torch
+
+from constants import PAD_IDX
+from model import SineKANFunction, SineKANLayer, build_kanformer
+
+
+def make_layers(is_first, chunk_size):
+    """An einsum layer and a recompute layer with the same float64 parameters."""
+    torch.manual_seed(0)
+    einsum = SineKANLayer(6, 5, device='cpu', grid_size=4, is_first=is_first, impl='einsum').double()
+    recompute = copy.deepcopy(einsum)
+    recompute.impl, recompute.chunk_size = 'recompute', chunk_size
+    return einsum, recompute
+
+
+@pytest.mark.parametrize('is_first', [False, True])
+@pytest.mark.parametrize('chunk_size', [7, 1024])
+def test_recompute_matches_einsum(is_first, chunk_size):
+    einsum, recompute = make_layers(is_first, chunk_size)
+    x = torch.randn(3, 13, 6, dtype=torch.float64)
+    outputs, grads = [], []
+    for layer in (einsum, recompute):
+        x_layer = x.clone().requires_grad_()
+        y = layer(x_layer)
+        # A non-uniform upstream gradient so that every output element counts differently
+        y.backward(torch.linspace(-1, 1, y.numel(), dtype=torch.float64).view_as(y))
+        outputs.append(y.detach())
+        grads.append([x_layer.grad] + [param.grad for param in layer.parameters()])
+
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=1e-12, atol=1e-12)
+    assert len(grads[0]) == len(grads[1]) == 4
+    for grad_recompute, grad_einsum in zip(grads[1], grads[0]):
+        torch.testing.assert_close(grad_recompute, grad_einsum, rtol=1e-12, atol=1e-12)
+
+
+
+@pytest.mark.parametrize('is_first', [False, True])
+@pytest.mark.parametrize('grid_size', [1, 4, 8])
+def test_trig_matches_einsum(is_first, grid_size):
+    torch.manual_seed(0)
+    einsum = SineKANLayer(6, 5, device='cpu', grid_size=grid_size, is_first=is_first, impl='einsum').double()
+    trig = copy.deepcopy(einsum)
+    trig.impl = 'trig'
+    x = torch.randn(3, 13, 6, dtype=torch.float64)
+    outputs, grads = [], []
+    for layer in (einsum, trig):
+        x_layer = x.clone().requires_grad_()
+        y = layer(x_layer)
+        y.backward(torch.linspace(-1, 1, y.numel(), dtype=torch.float64).view_as(y))
+        outputs.append(y.detach())
+        grads.append([x_layer.grad] + [param.grad for param in layer.parameters()])
+
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=1e-12, atol=1e-12)
+    assert len(grads[0]) == len(grads[1]) == 4
+    for grad_trig, grad_einsum in zip(grads[1], grads[0]):
+        torch.testing.assert_close(grad_trig, grad_einsum, rtol=1e-12, atol=1e-12)
+
+
+def test_sinekan_function_gradcheck():
+    torch.manual_seed(0)
+    x = torch.randn(9, 3, dtype=torch.float64, requires_grad=True)
+    freq = torch.rand(1, 1, 1, 4, dtype=torch.float64, requires_grad=True)
+    phase = torch.rand(1, 1, 3, 4, dtype=torch.float64, requires_grad=True)
+    amplitudes = torch.randn(2, 3, 4, dtype=torch.float64, requires_grad=True)
+    # A chunk size that does not divide the tokens exercises the last, shorter chunk
+    assert torch.autograd.gradcheck(lambda *args: SineKANFunction.apply(*args, 4), (x, freq, phase, amplitudes))
+
+
+@pytest.mark.parametrize('is_first', [False, True])
+def test_recompute_matches_einsum_under_autocast(is_first):
+    einsum, recompute = make_layers(is_first, 7)
+    einsum, recompute = einsum.float(), recompute.float()
+    x = torch.randn(3, 13, 6)
+    outputs, grads = [], []
+    for layer in (einsum, recompute):
+        x_layer = x.clone().requires_grad_()
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            y = layer(x_layer)
+            loss = (y.float() * torch.linspace(-1, 1, y.numel()).view_as(y)).sum()
+        loss.backward()
+        outputs.append(y.detach().float())
+        grads.append([x_layer.grad] + [param.grad for param in layer.parameters()])
+
+    # Both paths contract in bfloat16, only the rounding of their accumulations differs
+    torch.testing.assert_close(outputs[1], outputs[0], rtol=2e-2, atol=2e-2)
+    for grad_recompute, grad_einsum in zip(grads[1], grads[0]):
+        assert grad_recompute.dtype == grad_einsum.dtype
+        torch.testing.assert_close(grad_recompute, grad_einsum, rtol=5e-2, atol=5e-2)
+
+
+def test_decoder_beams_share_encoder_output():
+    torch.manual_seed(0)
+    model = build_kanformer(20, 20, 12, 12, d_model=32, N=2, h=4, dropout=0.0, d_ff=64, ff_dims=[16], device='cpu').eval()
+    src = torch.randint(3, 20, (3, 12))
+    src[0, 8:] = PAD_IDX
+    src_mask = model.make_src_mask(src)
+    memory = model.encode(src, src_mask)
+    beams = 4
+    example_idx = torch.arange(3).repeat_interleave(beams)
+    tgt = torch.randint(3, 20, (3 * beams, 5))
+    copied_cache, shared_cache = model.init_decoder_cache(), model.init_decoder_cache(beams=beams)
+    for step in range(tgt.size(1)):
+        copied = model.decode(memory[example_idx], src_mask[example_idx], tgt[:, step:step + 1], None, cache=copied_cache)
+        shared = model.decode(memory, src_mask, tgt[:, step:step + 1], None, cache=shared_cache)
+        torch.testing.assert_close(shared, copied, rtol=1e-5, atol=1e-5)
+
+    # Batch sizes that do not match the beam count are an error, not a guess
+    with pytest.raises(AssertionError):
+        model.decode(memory, src_mask, tgt[:, :1], None, cache=model.init_decoder_cache(beams=3))
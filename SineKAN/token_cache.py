@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import torch.distributed as dist
+from tqdm import tqdm
+
+from fn_utils import content_hash
+from ingest import iter_chunks
+from tokenizer import TOKENIZER_VERSION
+
+# Version of the cache file layout, part of the cache keys
+FORMAT_VERSION = 1
+
+
+class TokenCache:
+    """
+    Memory-mapped token ids of one dataset split.
+
+    The token ids of all source (and target) expressions are stored back to back
+    in one flat array, together with an offsets index such that the ids of sample
+    ``i`` are ``ids[offsets[i]:offsets[i + 1]]``.
+
+    Args:
+        path (str): Path prefix of the cache files.
+    """
+
+    ARRAYS = ('src', 'src_offsets', 'tgt', 'tgt_offsets')
+
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}.json") as f:
+            self.meta = json.load(f)
+        self._arrays = None
+
+    def __len__(self):
+        return self.meta['num_samples']
+
+    def __getstate__(self):
+        # Workers map the files themselves instead of receiving pickled copies
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def _load(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(f"{self.path}.{name}.npy", mmap_mode='r') for name in self.ARRAYS}
+        return self._arrays
+
+    def get(self, idx):
+        """
+        Get the token ids of a sample.
+
+        Args:
+            idx (int): Index of the sample.
+
+        Returns:
+            tuple: Source and target token ids as numpy arrays.
+        """
+        arrays = self._load()
+        src_offsets, tgt_offsets = arrays['src_offsets'], arrays['tgt_offsets']
+        src_ids = arrays['src'][src_offsets[idx]:src_offsets[idx + 1]]
+        tgt_ids = arrays['tgt'][tgt_offsets[idx]:tgt_offsets[idx + 1]]
+        return src_ids, tgt_ids
+
+    def lengths(self):
+        """
+        Get the number of source and target token ids of every sample.
+
+        Returns:
+            tuple: Source and target lengths as numpy arrays.
+        """
+        arrays = self._load()
+        return np.diff(arrays['src_offsets']), np.diff(arrays['tgt_offsets'])
+
+
+def cache_key(df, tokenizer, src_vocab, tgt_vocab, seed):
+    """
+    Hash the expressions, tokenizer settings and vocabularies a cache depends on.
+
+    Returns:
+        str: Hex digest identifying the cache.
+    """
+    settings = {
+        'format_version': FORMAT_VERSION,
+        'tokenizer_version': TOKENIZER_VERSION,
+        'to_replace': tokenizer.to_replace,
+        'index_pool_size': len(tokenizer.tokens_pool),
+        'momentum_pool_size': len(tokenizer.momentum_pool),
+        'seed': seed,
+    }
+    return content_hash(df, settings, (src_vocab, tgt_vocab))
+
+
+class _ArrayWriter:
+    """
+    Append values to a 1-D .npy file without holding the array in memory.
+
+    Values go to a raw scratch file, ``close`` prepends the .npy header once the length is
+    known and moves the result into place atomically, so readers never see a partial file.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.raw_path = f"{path}.raw{os.getpid()}"
+        self.raw = open(self.raw_path, 'wb')
+
+    def discard(self):
+        """Drop the values written so far."""
+        self.raw.close()
+        if os.path.exists(self.raw_path):
+            os.remove(self.raw_path)
+
+    def append(self, values):
+        array = np.asarray(values, dtype=self.dtype)
+        array.tofile(self.raw)
+        self.size += array.size
+
+    def close(self):
+        self.raw.close()
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.size,)}
+        with open(tmp_path, 'wb') as f, open(self.raw_path, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f)
+        os.remove(self.raw_path)
+        os.replace(tmp_path, self.path)
+
+
+def build_token_cache(df, tokenizer, src_vocab, tgt_vocab, seed, cache_dir, split):
+    """
+    Tokenize a split once and store its token ids, or reuse an existing cache.
+
+    The split is tokenized chunk by chunk and every chunk's ids are appended to the cache
+    files straight away, so only one chunk is ever held in memory.
+
+    Args:
+        df (DataFrame or StreamingCorpus): Expressions with 'amp' and 'sqamp' columns.
+        seed (int): Seed used for source token replacement.
+        cache_dir (str): Directory holding the cache files.
+        split (str): Name of the split, used as file name prefix.
+
+    Returns:
+        TokenCache: Cache of the split.
+    """
+    path = os.path.join(cache_dir, f"{split}_{cache_key(df, tokenizer, src_vocab, tgt_vocab, seed)}")
+    if os.path.exists(f"{path}.json"):
+        return TokenCache(path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dtype = np.int16 if max(len(src_vocab), len(tgt_vocab)) <= np.iinfo(np.int16).max else np.int32
+    src_writer, tgt_writer = _ArrayWriter(f"{path}.src.npy", dtype), _ArrayWriter(f"{path}.tgt.npy", dtype)
+    src_offsets_writer = _ArrayWriter(f"{path}.src_offsets.npy", np.int64)
+    tgt_offsets_writer = _ArrayWriter(f"{path}.tgt_offsets.npy", np.int64)
+    src_offsets_writer.append([0])
+    tgt_offsets_writer.append([0])
+
+    writers = (src_writer, tgt_writer, src_offsets_writer, tgt_offsets_writer)
+
+    num_samples = 0
+    try:
+        with tqdm(desc=f'Caching {split} tokens', unit='expr') as pbar:
+            for chunk in iter_chunks(df):
+                src_ids, tgt_ids = [], []
+                src_offsets, tgt_offsets = [], []
+                for amp, sqamp in zip(chunk['amp'], chunk['sqamp']):
+                    src_ids.extend(src_vocab(tokenizer.src_tokenize(amp, seed)))
+                    tgt_ids.extend(tgt_vocab(tokenizer.tgt_tokenize(sqamp)))
+                    src_offsets.append(src_writer.size + len(src_ids))
+                    tgt_offsets.append(tgt_writer.size + len(tgt_ids))
+                src_writer.append(src_ids)
+                tgt_writer.append(tgt_ids)
+                src_offsets_writer.append(src_offsets)
+                tgt_offsets_writer.append(tgt_offsets)
+                num_samples += len(chunk)
+                pbar.update(len(chunk))
+
+        for writer in writers:
+            writer.close()
+    finally:
+        # Scratch files of a failed build are not left behind, closed writers have none
+        for writer in writers:
+            writer.discard()
+
+    # The metadata file is written last and marks the cache as complete
+    meta = {'num_samples': num_samples, 'dtype': np.dtype(dtype).name, 'split': split}
+    tmp_path = f"{path}.json.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, f"{path}.json")
+    return TokenCache(path)
+
+
+def build_token_caches(dfs, config, tokenizer, src_vocab, tgt_vocab):
+    """
+    Build or load the token caches of several splits.
+
+    Under torch.distributed only the first rank hashes and tokenizes the splits. It then
+    shares the cache paths, and the other ranks map the finished files without reading
+    the data, so their splits may be None.
+
+    Args:
+        dfs (dict): DataFrames or StreamingCorpus keyed by split name.
+
+    Returns:
+        dict: TokenCache for every split.
+    """
+    cache_dir = config.token_cache_dir or os.path.join(config.root_dir, 'token_cache')
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+    caches = None
+    if not distributed or dist.get_rank() == 0:
+        caches = {split: build_token_cache(df, tokenizer, src_vocab, tgt_vocab, config.seed, cache_dir, split)
+                  for split, df in dfs.items()}
+    if not distributed:
+        return caches
+
+    # Object collectives pickle through CPU tensors, so they run on a gloo group
+    group = dist.new_group(backend='gloo')
+    payload = [{split: cache.path for split, cache in caches.items()} if caches is not None else None]
+    dist.broadcast_object_list(payload, src=0, group=group)
+    dist.destroy_process_group(group)
+    if caches is not None:
+        return caches
+    return {split: TokenCache(path) for split, path in payload[0].items()}
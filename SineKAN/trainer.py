@@ -1,45 +1,115 @@
 from tqdm import tqdm
+from beam_search import BeamSearch
+from checkpoint import CheckpointWriter
 from data import Data
-from fn_utils import calculate_line_params, causal_mask, generate_unique_random_integers, get_model, decode_sequence
+from fn_utils import calculate_line_params, generate_unique_random_integers, get_model, decode_sequence, pad_collate_fn
+from profiling import StepProfiler
+from samplers import BucketBatchSampler
+from shards import ShardedData
 import torch
+import contextlib
+import math
 import os
 from torch.optim.lr_scheduler import LambdaLR
 from torch.cuda.amp import GradScaler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import wandb
 import numpy as np
+from collections import OrderedDict
 
 from constants import BOS_IDX, PAD_IDX, EOS_IDX
 
-def sequence_accuracy(config,test_ds,tgt_itos,load_best=True, epoch=None,test_size=100):
+# Model states of checkpoints used for predictions, kept on the CPU and keyed by checkpoint path
+_STATE_CACHE = OrderedDict()
+_STATE_CACHE_SIZE = 2
+
+def load_checkpoint_state(path):
+    """
+    Get the model state of a checkpoint, reusing the cached copy while the file is unchanged.
+
+    The state stays on the CPU, so cached checkpoints do not hold device memory between
+    evaluations.
+
+    Args:
+        path (str): Path of the checkpoint.
+
+    Returns:
+        dict: Checkpoint with the 'state_dict' and 'epoch' entries.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _STATE_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        _STATE_CACHE.move_to_end(path)
+        return cached[1]
+
+    # Memory-mapped so that the optimizer state is never read
+    checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    state = {'state_dict': checkpoint['state_dict'], 'epoch': checkpoint['epoch']}
+    _STATE_CACHE[path] = (mtime, state)
+    _STATE_CACHE.move_to_end(path)
+    while len(_STATE_CACHE) > _STATE_CACHE_SIZE:
+        _STATE_CACHE.popitem(last=False)
+    return state
+
+# Model that checkpoints are loaded into for predictions, kept on the CPU between evaluations,
+# as (configuration, model) of the latest configuration
+_EVAL_MODEL = None
+
+def get_eval_model(config):
+    """
+    Get the CPU model that checkpoints of a configuration are loaded into.
+
+    The model is built and initialised once per configuration, later evaluations only load
+    their checkpoint state into it.
+
+    Returns:
+        Model: Model on the CPU.
+    """
+    global _EVAL_MODEL
+    key = repr(sorted(config.to_dict().items()))
+    if _EVAL_MODEL is None or _EVAL_MODEL[0] != key:
+        _EVAL_MODEL = (key, get_model(config).cpu())
+    return _EVAL_MODEL[1]
+
+def sequence_accuracy(config,test_ds,tgt_itos,load_best=True, epoch=None,test_size=100, model=None):
     """
     Calculate the sequence accuracy.
 
     Args:
         load_best (bool, optional): Whether to load the best model. Defaults to True.
         epochs (int, optional): Number of epochs. Defaults to None.
+        model (Transformer, optional): In-memory model to evaluate instead of a checkpoint.
 
     Returns:
         float: Sequence accuracy.
     """
-    predictor = Predictor(config,load_best, epoch)
+    if model is not None:
+        predictor = Predictor(config, model=model)
+    else:
+        predictor = Predictor(config, load_best, epoch)
     count = 0
     num_samples = 10 if config.debug else test_size 
     random_idx = generate_unique_random_integers(
         num_samples, start=0, end=len(test_ds))
     length = len(random_idx)
-    pbar = tqdm(range(length))
+    test_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(test_ds, random_idx),
+                                              batch_size=config.test_batch_size, shuffle=False)
+    pbar = tqdm(test_loader)
     pbar.set_description("Seq_Acc_Cal")
-    for i in pbar:
-        original_tokens, predicted_tokens = predictor.predict(
-            test_ds[random_idx[i]],tgt_itos, raw_tokens=True)
-        original_tokens = original_tokens.detach().numpy().tolist()
-        predicted_tokens = predicted_tokens.detach().cpu().numpy().tolist()
-        original = decode_sequence(original_tokens,tgt_itos)
-        predicted = decode_sequence(predicted_tokens,tgt_itos)
-        if original == predicted:
-            count = count + 1
-        pbar.set_postfix(seq_accuracy=count / (i + 1))
+    seen = 0
+    for src, tgt, _ in pbar:
+        predicted_batch = predictor.predict_batch(src)
+        for original_tokens, predicted_tokens in zip(tgt.tolist(), predicted_batch):
+            original = decode_sequence(original_tokens,tgt_itos)
+            predicted = decode_sequence(predicted_tokens,tgt_itos)
+            if original == predicted:
+                count = count + 1
+        seen += len(predicted_batch)
+        pbar.set_postfix(seq_accuracy=count / seen)
+    if model is None:
+        # The checkpoint model only occupies the device during the test
+        predictor.model.cpu()
     return count / length
 
 
@@ -51,6 +121,7 @@ class Predictor:
         config (object): Configuration object containing model and inference settings.
         load_best (bool, optional): Whether to load the best model. Defaults to True.
         epoch (int, optional): Epoch number to load a specific checkpoint.
+        model (Transformer, optional): In-memory model to use instead of loading a checkpoint.
 
     Attributes:
         model (Model): Trained model for prediction.
@@ -60,15 +131,25 @@ class Predictor:
         max_len (int): Maximum target sequence length for inference.
     """
 
-    def __init__(self, config, load_best=True, epoch=None):
-        self.model = get_model(config)
+    def __init__(self, config, load_best=True, epoch=None, model=None):
+        # Maximum target length for inference
+        self.max_len = config.tgt_max_len
+
+        # Beam search settings, a beam width of 1 decodes greedily
+        self.beam_search = BeamSearch(config.beam_width, self.max_len, config.length_penalty, config.early_stopping)
+
+        if model is not None:
+            self.model = model
+            self.checkpoint = None
+            self.path = None
+            self.device = next(model.parameters()).device
+            print("Using in-memory model for predictions.")
+            return
+
+        self.model = get_eval_model(config)
         
         # Determine checkpoint path
-        if load_best:
-            self.checkpoint = f"{config.model_name}_best.pth"
-        else:
-            self.checkpoint = f"{config.model_name}_ep{epoch + 1}.pth"
-        
+        self.checkpoint = Predictor.checkpoint_name(config, load_best, epoch)
         self.path = os.path.join(config.root_dir, self.checkpoint)
         
         # Set device for inference
@@ -76,23 +157,26 @@ class Predictor:
             f"cuda:{config.device}" if "cuda" not in str(config.device) else config.device
         )
         
-        # Load model state
-        state = torch.load(self.path, map_location=self.device)
+        # Load model state, reused from the CPU cache while the checkpoint is unchanged
+        state = load_checkpoint_state(self.path)
         self.model.load_state_dict(state['state_dict'])
         self.model.to(self.device)
         
-        # Maximum target length for inference
-        self.max_len = config.tgt_max_len
-        
         print(f"Using epoch {state['epoch']} model for predictions.")
 
-    def greedy_decode(self, src, src_mask, max_len, start_symbol):
+    @staticmethod
+    def checkpoint_name(config, load_best=True, epoch=None):
+        """Name of the checkpoint file used for predictions."""
+        if load_best:
+            return f"{config.model_name}_best.pth"
+        return f"{config.model_name}_ep{epoch + 1}.pth"
+
+    def greedy_decode(self, src, max_len, start_symbol):
         """
-        Generate a sequence using greedy decoding.
+        Generate a sequence using greedy decoding with cached decoder keys/values.
 
         Args:
             src (Tensor): Source input.
-            src_mask (Tensor): Mask for source input.
             max_len (int): Maximum length of the generated sequence.
             start_symbol (int): Start symbol for decoding.
 
@@ -100,16 +184,15 @@ class Predictor:
             Tensor: Generated sequence.
         """
         src = src.to(self.device)
-        src_mask = src_mask.to(self.device)
         src = src.unsqueeze(0)
-        src_mask = src_mask.unsqueeze(0)
+        src_mask = self.model.make_src_mask(src)
         memory = self.model.encode(src, src_mask)
         memory = memory.to(self.device)
+        # Only the newest token is fed to the decoder, earlier positions live in the cache
+        cache = self.model.init_decoder_cache()
         ys = torch.ones(1, 1).fill_(start_symbol).type(torch.long).to(self.device)
         for _ in range(max_len - 1):
-            tgt_mask =(causal_mask(ys.size(1)).type(torch.bool)).to(self.device)
-            tgt_mask = tgt_mask.unsqueeze(0)
-            out = self.model.decode(memory,src_mask,ys,tgt_mask)
+            out = self.model.decode(memory, src_mask, ys[:, -1:], None, cache=cache)
             prob = self.model.project(out[:,-1])
 
             _, next_word = torch.max(prob, dim=1)
@@ -120,6 +203,85 @@ class Predictor:
                 break
         return ys
 
+    @torch.no_grad()
+    def batch_greedy_decode(self, src, max_len, start_symbol):
+        """
+        Generate sequences for a batch of sources using greedy decoding.
+
+        Args:
+            src (Tensor): Padded source inputs of shape (batch, src_len).
+            max_len (int): Maximum length of the generated sequences.
+            start_symbol (int): Start symbol for decoding.
+
+        Returns:
+            list: Generated token ids for every row, up to and including EOS.
+        """
+        src = src.to(self.device)
+        src_mask = self.model.make_src_mask(src)
+        memory = self.model.encode(src, src_mask)
+        cache = self.model.init_decoder_cache()
+        ys = torch.full((src.size(0), 1), start_symbol, dtype=torch.long, device=self.device)
+        finished = torch.zeros(src.size(0), dtype=torch.bool, device=self.device)
+        for _ in range(max_len - 1):
+            out = self.model.decode(memory, src_mask, ys[:, -1:], None, cache=cache)
+            prob = self.model.project(out[:, -1])
+
+            # Rows that already emitted EOS keep producing padding
+            next_word = prob.argmax(dim=1).masked_fill(finished, PAD_IDX)
+            ys = torch.cat([ys, next_word.unsqueeze(1)], dim=1)
+            finished |= next_word == EOS_IDX
+            if finished.all():
+                break
+
+        sequences = []
+        for row in ys.tolist():
+            if EOS_IDX in row:
+                row = row[:row.index(EOS_IDX) + 1]
+            sequences.append(row)
+        return sequences
+
+    @torch.no_grad()
+    def beam_search_decode(self, src, start_symbol):
+        """
+        Generate sequences for a batch of sources using beam search.
+
+        Args:
+            src (Tensor): Padded source inputs of shape (batch, src_len).
+            start_symbol (int): Start symbol for decoding.
+
+        Returns:
+            list: Best token ids for every row, up to and including EOS.
+        """
+        src = src.to(self.device)
+        src_mask = self.model.make_src_mask(src)
+        memory = self.model.encode(src, src_mask)
+
+        # The encoder output and its cross-attention keys and values are computed once per example,
+        # the beams of an example all attend to them without copies
+        cache = self.model.init_decoder_cache(beams=self.beam_search.beam_width)
+
+        def step(ys):
+            out = self.model.decode(memory, src_mask, ys[:, -1:], None, cache=cache)
+            return torch.log_softmax(self.model.project(out[:, -1]), dim=-1)
+
+        return self.beam_search.search(step, src.size(0), start_symbol, self.device,
+                                       reorder_fn=lambda beam_idx: self.model.reorder_decoder_cache(cache, beam_idx))
+
+    def predict_batch(self, src):
+        """
+        Generate predictions for a batch of test examples.
+
+        Args:
+            src (Tensor): Padded source inputs of shape (batch, src_len).
+
+        Returns:
+            list: Predicted token ids for every example.
+        """
+        self.model.eval()
+        if self.beam_search.beam_width > 1:
+            return self.beam_search_decode(src, start_symbol=BOS_IDX)
+        return self.batch_greedy_decode(src, max_len=self.max_len, start_symbol=BOS_IDX)
+
     def predict(self, test_example, itos, raw_tokens=False):
         """
         Generate prediction for a test example.
@@ -135,9 +297,8 @@ class Predictor:
 
         src = test_example[0]
 
-        src_mask = test_example[3]
         tgt_tokens = self.greedy_decode(
-            src, src_mask, max_len=self.max_len, start_symbol=BOS_IDX).flatten()
+            src, max_len=self.max_len, start_symbol=BOS_IDX).flatten()
 
         if raw_tokens:
             original_tokens = test_example[1]
@@ -198,6 +359,9 @@ class Trainer:
         self.config = config
         self.config.device = self.device
         self.is_master = self.local_rank == 0
+        # Writes and tests checkpoints: every local master, or under ZeRO global rank 0 only,
+        # the one rank holding the consolidated optimizer state
+        self.is_saver = self.global_rank == 0 if config.zero_optimizer else self.is_master
         
         if self.is_master:
             wandb.login()
@@ -213,11 +377,17 @@ class Trainer:
             df_train, df_test, df_valid, tokenizer, src_vocab, tgt_vocab
         )
         
-        # Training parameters
-        self.warmup_steps = int(
-            config.warmup_ratio * len(self.dataloaders['train']) * config.epochs
-        )
-        self.ep_steps = len(self.dataloaders['train'])
+        # Training parameters, counted in optimizer steps
+        train_sampler = self.dataloaders['train'].batch_sampler
+        if isinstance(train_sampler, BucketBatchSampler):
+            # Packed to max_tokens, every epoch has its own number of batches
+            epoch_batches = train_sampler.epoch_lengths(range(config.epochs))
+        else:
+            epoch_batches = [len(self.dataloaders['train'])] * config.epochs
+        self.epoch_steps = [math.ceil(num_batches / config.grad_accum_steps) for num_batches in epoch_batches]
+        # First optimizer step of every epoch
+        self.epoch_start_steps = np.cumsum([0] + self.epoch_steps[:-1])
+        self.warmup_steps = int(config.warmup_ratio * sum(self.epoch_steps))
         self.root_dir = config.root_dir
         self.current_epoch = config.curr_epoch
         self.best_val_loss = float('inf')
@@ -236,6 +406,9 @@ class Trainer:
         self.save_last = config.save_last
         self.lr = config.update_lr
         self.global_step = 0
+        # Samples of the current epoch this rank has trained on, saved with mid-epoch checkpoints
+        self.sample_offset = 0
+        self.step_ckp_path = None
         
         # Target vocabulary
         self.tgt_itos = tgt_itos
@@ -243,9 +416,19 @@ class Trainer:
         # Checkpoint management
         self.ckp_paths = [
             file for file in os.listdir(config.root_dir)
-            if ('best' not in file and config.model_name in file)
+            if ('best' not in file and config.model_name in file and file.endswith('.pth')
+                and not file.startswith(f"{config.model_name}_step"))
         ]
         self.save_limit = config.save_limit
+        self.checkpoint_writer = CheckpointWriter(self.ckp_paths, self.save_limit)
+        self.pending_metrics = None
+
+        # Opt-in step profiling
+        self.profiler = StepProfiler(
+            config.profile, self.device, run=self.run if self.is_master else None, log_freq=config.log_freq,
+            window=config.profile_window, trace_dir=config.profile_trace_dir,
+            trace_start=config.profile_trace_start, trace_steps=config.profile_trace_steps, rank=self.global_rank
+        )
 
     def criterion(self, y_pred, y_true):
         """
@@ -270,7 +453,10 @@ class Trainer:
         """
         model = get_model(self.config)
         model.to(self.device)
-        ddp_model = DDP(model, device_ids=[self.device])
+        # All buffers are constants (positional encodings, phases, causal mask), so they are not broadcast
+        ddp_model = DDP(model, device_ids=[self.device], broadcast_buffers=False,
+                        bucket_cap_mb=self.config.ddp_bucket_cap_mb,
+                        gradient_as_bucket_view=self.config.gradient_as_bucket_view)
         if self.is_master:
             self.run.watch(ddp_model.module,log_freq=20)
         print(model)
@@ -284,6 +470,11 @@ class Trainer:
             Optimizer: Initialized optimizer.
         """
         param_optimizer = list(self.ddp_model.parameters())
+        if self.config.zero_optimizer:
+            # Every rank keeps the AdamW moments of its own shard of the parameters only
+            return ZeroRedundancyOptimizer(
+                param_optimizer, optimizer_class=torch.optim.AdamW, lr=self.config.optimizer_lr, eps=1e-9,
+                weight_decay=self.config.weight_decay)
         optimizer = torch.optim.AdamW(
             param_optimizer, lr=self.config.optimizer_lr, eps=1e-9, weight_decay = self.config.weight_decay)
         return optimizer
@@ -322,12 +513,28 @@ class Trainer:
         """
         datasets = Data.get_data(
             df_train, df_test, df_valid, self.config, tokenizer,src_vocab, tgt_vocab)
-        sampler_train = torch.utils.data.DistributedSampler(datasets['train'], num_replicas=self.config.world_size,
-                                                            rank=self.device, shuffle=self.config.train_shuffle)
+        if self.config.bucket_batches or self.config.max_tokens is not None:
+            if self.config.iterable_data:
+                raise ValueError("iterable_data batches a fixed number of samples, it cannot be combined with "
+                                 "bucket_batches or max_tokens")
+            return self._prepare_bucket_dataloaders(datasets), datasets['test']
+
+        if self.config.iterable_data:
+            # Every rank streams batches of its own shards of the token cache
+            train_ds = ShardedData(datasets['train'], self.config.training_batch_size,
+                                   num_replicas=self.config.world_size, rank=self.global_rank,
+                                   num_workers=self.config.num_workers, shuffle=self.config.train_shuffle,
+                                   shard_size=self.config.shard_size, shuffle_buffer=self.config.shuffle_buffer,
+                                   seed=self.config.seed)
+            train_loader = torch.utils.data.DataLoader(train_ds, batch_size=None, num_workers=self.config.num_workers,
+                                                       pin_memory=self.config.pin_memory)
+        else:
+            sampler_train = torch.utils.data.DistributedSampler(datasets['train'], num_replicas=self.config.world_size,
+                                                                rank=self.global_rank, shuffle=self.config.train_shuffle)
 
-        train_loader = torch.utils.data.DataLoader(datasets['train'], batch_size=self.config.training_batch_size,
-                                                   sampler=sampler_train, num_workers=self.config.num_workers,
-                                                   pin_memory=self.config.pin_memory)
+            train_loader = torch.utils.data.DataLoader(datasets['train'], batch_size=self.config.training_batch_size,
+                                                       sampler=sampler_train, num_workers=self.config.num_workers,
+                                                       pin_memory=self.config.pin_memory)
 
         dataloaders = {
             'train': train_loader,
@@ -337,23 +544,56 @@ class Trainer:
         }
         return dataloaders,datasets['test']
 
-    def load_model(self, resume=False, epoch=None, lr=None):
+    def _prepare_bucket_dataloaders(self, datasets):
+        """
+        Prepare train and validation dataloaders whose batches group sequences of similar
+        length and are padded to their longest sequence. With max_tokens, batches are
+        packed up to a token budget instead of a fixed number of sequences.
+
+        Returns:
+            dict: Dictionary containing train and validation dataloaders.
+        """
+        max_tokens = self.config.max_tokens
+        sampler_train = BucketBatchSampler(datasets['train'].lengths(),
+                                           self.config.training_batch_size if max_tokens is None else None,
+                                           num_replicas=self.config.world_size, rank=self.global_rank,
+                                           shuffle=self.config.train_shuffle,
+                                           bucket_size_multiplier=self.config.bucket_size_multiplier,
+                                           seed=self.config.seed, max_tokens=max_tokens)
+        sampler_valid = BucketBatchSampler(datasets['valid'].lengths(),
+                                           self.config.valid_batch_size if max_tokens is None else None,
+                                           shuffle=self.config.valid_shuffle,
+                                           bucket_size_multiplier=self.config.bucket_size_multiplier,
+                                           seed=self.config.seed, max_tokens=max_tokens)
+        return {
+            split: torch.utils.data.DataLoader(datasets[split], batch_sampler=sampler, collate_fn=pad_collate_fn,
+                                               num_workers=self.config.num_workers, pin_memory=self.config.pin_memory)
+            for split, sampler in (('train', sampler_train), ('valid', sampler_valid))
+        }
+
+    def load_model(self, resume=False, epoch=None, lr=None, step=None):
         """
         Load the most recent model checkpoint.
 
         Args:
             resume (bool, optional): Whether to resume training. Defaults to False.
             epoch (int, optional): Load model from a particular epoch
+            step (int, optional): Load the mid-epoch checkpoint of a particular step
         """
-        checkpoint_name = f"{self.config.model_name}_best.pth" if resume else f"{self.config.model_name}_ep{epoch}.pth"
+        if step is not None:
+            checkpoint_name = f"{self.config.model_name}_step{step}.pth"
+        else:
+            checkpoint_name = f"{self.config.model_name}_best.pth" if resume else f"{self.config.model_name}_ep{epoch}.pth"
         file = os.path.join(self.root_dir, checkpoint_name)
+        self.checkpoint_writer.flush()
         device_name = f"cuda:{self.device}"
         state = torch.load(file, map_location=device_name)
         self.model.load_state_dict(state['state_dict'])
-        if resume or (epoch != None):
+        if resume or (epoch != None) or (step != None):
             self.train_loss_list = state['train_loss_list']
             self.valid_loss_list = state['valid_loss_list']
-            self.best_val_loss = np.array(self.valid_loss_list).min()
+            # Checkpoints from the first epoch have not been validated yet
+            self.best_val_loss = min(self.valid_loss_list, default=float('inf'))
             self.optimizer.load_state_dict(state['optimizer'])
             
             if state['decay_scheduler'] is not None and self.lr_scheduler is not None:
@@ -361,6 +601,7 @@ class Trainer:
             if state['warm_scheduler'] is not None and self.warm_scheduler is not None:
                 self.warm_scheduler.load_state_dict(state['warm_scheduler'])
             self.global_step = state['global_step']
+            self.sample_offset = state.get('sample_offset', 0)
 
             if epoch == None:
                 self.current_epoch = state['epoch']
@@ -373,6 +614,50 @@ class Trainer:
             print(checkpoint_name)
             print("Loaded :)")
 
+    def _grad_norm(self):
+        """Total L2 norm of the gradients, reduced on the device without flattening them."""
+        grads = [param.grad for param in self.ddp_model.module.parameters() if param.grad is not None]
+        return torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
+
+    def _queue_train_metrics(self, **metrics):
+        """
+        Start copying scalar device tensors of the current step to the host without waiting.
+
+        Args:
+            **metrics: Scalar tensors keyed by name.
+        """
+        values = torch.stack([value.detach().float() for value in metrics.values()])
+        host = torch.empty(values.shape, dtype=values.dtype, pin_memory=values.is_cuda)
+        host.copy_(values, non_blocking=True)
+        event = None
+        if values.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self.pending_metrics = (self.global_step, list(metrics), host, event)
+
+    def _flush_train_metrics(self):
+        """
+        Log the queued training metrics.
+
+        Returns:
+            dict: Logged values, or None if nothing was queued.
+        """
+        if self.pending_metrics is None:
+            return None
+        step, names, host, event = self.pending_metrics
+        self.pending_metrics = None
+        if event is not None:
+            event.synchronize()
+        values = dict(zip(names, host.tolist()))
+        self.run.log({'train/loss': values['loss'], 'train/grad_norm': values['grad_norm'],
+                      'train/epoch': self._epoch_progress(step), 'global_step': step})
+        return values
+
+    def _epoch_progress(self, step):
+        """Fractional number of epochs done at an optimizer step."""
+        epoch = max(np.searchsorted(self.epoch_start_steps, step, side='right') - 1, 0)
+        return epoch + (step - self.epoch_start_steps[epoch]) / self.epoch_steps[epoch]
+
     def _train_epoch(self):
         """
         Perform a single training epoch.
@@ -381,54 +666,81 @@ class Trainer:
             float: Average training loss for the epoch.
         """
         self.ddp_model.train()
+        if isinstance(self.dataloaders['train'].batch_sampler, BucketBatchSampler):
+            self.dataloaders['train'].batch_sampler.set_epoch(self.current_epoch)
+        train_data = self.dataloaders['train'].dataset
+        if isinstance(train_data, ShardedData):
+            # Skips the samples a mid-epoch checkpoint was taken after
+            train_data.set_epoch(self.current_epoch, self.sample_offset)
+        elif self.sample_offset:
+            print(f"Only iterable_data resumes mid-epoch, epoch {self.current_epoch + 1} restarts from its start")
+            self.sample_offset = 0
         pbar = tqdm(self.dataloaders['train'],
                     total=len(self.dataloaders['train']),disable= (not self.is_master))
         pbar.set_description(
             f"[{self.current_epoch+1}/{self.config.epochs}] Train")
-        running_loss = 0.0
+        running_loss = torch.zeros((), device=self.device)
+        step_loss = torch.zeros((), device=self.device)
         total_samples = 0
+        accum_steps = self.config.grad_accum_steps
+        num_batches = len(self.dataloaders['train'])
+
+        for i, (src, tgt,label) in enumerate(self.profiler.iterate(pbar)):
+            # The last optimizer step of an epoch may accumulate fewer micro-batches
+            first = i - i % accum_steps
+            micro_steps = min(accum_steps, num_batches - first)
+            is_step = i == first + micro_steps - 1
+            if i == first:
+                self.optimizer.zero_grad()
+                step_loss.zero_()
+
+            with self.profiler.phase('h2d'):
+                src = src.to(self.device)
+                tgt = tgt.to(self.device)
+                bs = src.size(0)
+                src_mask = self.model.make_src_mask(src)
+                tgt_mask = self.model.make_tgt_mask(tgt)
+                label = label.to(self.device)
 
-        for src, tgt,label,src_mask, tgt_mask in pbar:
-            src = src.to(self.device)
-            tgt = tgt.to(self.device)
-            bs = src.size(0)
-            src_mask = src_mask.to(self.device)
-            tgt_mask = tgt_mask.to(self.device)
-            label = label.to(self.device)
-
-            with torch.autocast(device_type='cuda', dtype=self.dtype):
+            # Gradients are only all-reduced on the last micro-batch of an optimizer step
+            sync_context = contextlib.nullcontext() if is_step else self.ddp_model.no_sync()
+            with sync_context:
+                with self.profiler.phase('forward'), torch.autocast(device_type='cuda', dtype=self.dtype):
+                    # Going through the DDP forward prepares the gradient all-reduce of the backward pass
+                    logits = self.ddp_model(src, tgt, src_mask, tgt_mask) # (B, seq_len, tgt_vocab_size)
+                    # Calculate loss
+                    loss = self.criterion(logits.reshape(-1, logits.shape[-1]), label.reshape(-1))
+                running_loss += loss.detach().float() * bs
+                step_loss += loss.detach().float() / micro_steps
+                total_samples += bs
+                self.sample_offset += bs
+
+                # Backward
+                with self.profiler.phase('backward'):
+                    self.scaler.scale(loss / micro_steps).backward()
+
+            if not is_step:
+                continue
+
+            with self.profiler.phase('optimizer'):
+                self.scaler.unscale_(self.optimizer)
+                norm = None
+                if self.config.clip_grad_norm > 0:
+                    norm = torch.nn.utils.clip_grad_norm_(
+                        self.ddp_model.module.parameters(), self.config.clip_grad_norm)
+
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+
+            if (self.global_step % self.config.log_freq == 0) and self.is_master:
+                # Metrics are read back one logging step late, by then the copy has long finished
+                logged = self._flush_train_metrics()
+                if logged is not None:
+                    pbar.set_postfix(loss=logged['avg_loss'])
+                self._queue_train_metrics(
+                    loss=step_loss, grad_norm=self._grad_norm() if norm is None else norm,
+                    avg_loss=running_loss / total_samples)
 
-                encoder_output = self.ddp_model.module.encode(src, src_mask) # (B, seq_len, d_model)
-                decoder_output = self.ddp_model.module.decode(encoder_output, src_mask, tgt, tgt_mask) # (B, seq_len, d_model)
-                logits= self.ddp_model.module.project(decoder_output)
-                # Calculate loss
-                loss = self.criterion(logits.reshape(-1, logits.shape[-1]), label.reshape(-1))
-            if ((self.global_step % self.config.log_freq == 0) and self.is_master):
-                self.run.log({'train/loss': loss.item(),
-                          'global_step': self.global_step})
-            running_loss += loss.item() * bs
-            total_samples += bs
-            avg_loss = running_loss / total_samples
-            pbar.set_postfix(loss=avg_loss)
-
-            # Backward
-            self.optimizer.zero_grad()
-            self.scaler.scale(loss).backward()
-
-            self.scaler.unscale_(self.optimizer)
-            if self.config.clip_grad_norm > 0:
-                torch.nn.utils.clip_grad_norm_(
-                    self.ddp_model.module.parameters(), self.config.clip_grad_norm)
-            
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
-
-            grads = [
-                param.grad.detach().flatten()
-                for param in self.ddp_model.module.parameters()
-                if param.grad is not None ]
-            norm = torch.cat(grads).norm()
-           
             if (self.global_step <= self.warmup_steps):
                 if self.is_master:
                     lr = self.optimizer.param_groups[0]['lr']
@@ -439,16 +751,23 @@ class Trainer:
                 if (self.global_step % self.config.log_freq == 0) and self.is_master:
                     lr = self.optimizer.param_groups[0]['lr']
                     self.run.log({'train/lr': lr, 'global_step': self.global_step})
-                
-            if ((self.global_step % self.config.log_freq) == 0) and self.is_master:
-                self.run.log({'train/epoch': self.global_step /
-                          self.ep_steps, 'global_step': self.global_step})
-                self.run.log({'train/grad_norm': norm, 'global_step': self.global_step})
 
-            
+            self.profiler.step(self.global_step)
             self.global_step += 1
 
-        return avg_loss
+            # The last step of the epoch is covered by the epoch checkpoints
+            if self.config.save_steps and self.global_step % self.config.save_steps == 0 and i < num_batches - 1:
+                self._consolidate_optimizer()
+                if self.is_saver:
+                    # Step checkpoints stay out of the epoch rotation, only the latest one is kept
+                    step_ckp_path = os.path.join(self.root_dir, f"{self.config.model_name}_step{self.global_step}.pth")
+                    self._save_model(os.path.basename(step_ckp_path), rotate=False, replaces=self.step_ckp_path)
+                    self.step_ckp_path = step_ckp_path
+
+        self.sample_offset = 0
+        if self.is_master:
+            self._flush_train_metrics()
+        return running_loss.item() / total_samples
 
     def evaluate(self, phase):
         """
@@ -469,17 +788,15 @@ class Trainer:
         total_samples = 0
 
         with torch.no_grad():
-            for src, tgt,label,src_mask, tgt_mask in pbar:
+            for src, tgt,label in pbar:
                 src = src.to(self.device)
                 tgt = tgt.to(self.device)
                 bs = src.size(0)
-                src_mask = src_mask.to(self.device)
-                tgt_mask = tgt_mask.to(self.device)
+                src_mask = self.model.make_src_mask(src)
+                tgt_mask = self.model.make_tgt_mask(tgt)
                 label = label.to(self.device)
 
-                encoder_output = self.ddp_model.module.encode(src, src_mask) # (B, seq_len, d_model)
-                decoder_output = self.ddp_model.module.decode(encoder_output, src_mask, tgt, tgt_mask) # (B, seq_len, d_model)
-                logits= self.ddp_model.module.project(decoder_output)
+                logits = self.model(src, tgt, src_mask, tgt_mask) # (B, seq_len, tgt_vocab_size)
                 loss = self.criterion(logits.reshape(-1, logits.shape[-1]), label.reshape(-1))
 
                 running_loss += loss.item() * bs
@@ -488,42 +805,69 @@ class Trainer:
 
         return avg_loss
 
-    def _save_model(self, checkpoint_name):
+    def _save_model(self, checkpoint_name, rotate=True, replaces=None):
         """
         Save the model checkpoint.
 
         Args:
             checkpoint_name (str): Name of the checkpoint file.
+            rotate (bool, optional): Whether the file takes part in the save_limit rotation, best
+                checkpoints never do. Defaults to True.
+            replaces (str, optional): Earlier checkpoint to delete once this one is written. Defaults to None.
         """
-        state_dict = self.ddp_model.module.state_dict()
         ckp_path = os.path.join(self.root_dir, checkpoint_name)
-        torch.save({
-            "epoch": self.current_epoch + 1,
-            "state_dict": state_dict,
+        # A mid-epoch checkpoint continues its epoch after the first sample_offset samples
+        epoch = self.current_epoch if self.sample_offset else self.current_epoch + 1
+        # Only snapshots the state, the file is written in the background
+        self.checkpoint_writer.save({
+            "epoch": epoch,
+            "state_dict": self.ddp_model.module.state_dict(),
             'optimizer': self.optimizer.state_dict(),
             'decay_scheduler': self.lr_scheduler.state_dict() if self.lr_scheduler else None,
             'warm_scheduler': self.warm_scheduler.state_dict() if self.warm_scheduler else None,
             "train_loss_list": self.train_loss_list,
             "valid_loss_list": self.valid_loss_list,
-            "global_step": self.global_step
-        }, ckp_path)
+            "global_step": self.global_step,
+            "sample_offset": self.sample_offset
+        }, ckp_path, rotate=rotate and "best" not in checkpoint_name, replaces=replaces)
 
-        if "best" not in  checkpoint_name:
-            self.ckp_paths.append(ckp_path)
-        
-        # Remove oldest checkpoint if exceeding save_limit
-        if len(self.ckp_paths) > self.save_limit:
-            oldest_checkpoint = self.ckp_paths.pop(0)
-            if os.path.exists(oldest_checkpoint):
-                os.remove(oldest_checkpoint)
-                print(f"Deleted old checkpoint: {oldest_checkpoint}")
-        
+
+    def _checkpoints_due(self, valid_loss):
+        """
+        Decide which checkpoints the epoch saves.
+
+        Under ZeRO every rank has to take part in consolidating the optimizer state, so the
+        decision of global rank 0 is shared with the others.
+
+        Returns:
+            tuple: Whether the best and the epoch checkpoint are saved.
+        """
+        save_best = valid_loss <= self.best_val_loss
+        save_epoch = bool(self.save_freq) and (self.current_epoch + 1) % self.save_freq == 0
+        if self.config.zero_optimizer:
+            decision = torch.tensor([save_best], dtype=torch.uint8, device=self.device)
+            torch.distributed.broadcast(decision, src=0)
+            save_best = bool(decision.item())
+        return save_best, save_epoch
+
+    def _consolidate_optimizer(self):
+        """
+        Gather a sharded optimizer state on global rank 0 so that it can be saved.
+
+        Collective, so it has to run on every rank before a checkpoint is saved.
+        """
+        if self.config.zero_optimizer:
+            self.optimizer.consolidate_state_dict(to=0)
 
     def _test_seq_acc(self, load_best=True, epochs=None):
         """
         Test sequence accuracy and save results to a file.
         """
-        test_accuracy_seq = sequence_accuracy(self.config,self.test_ds,self.tgt_itos,load_best, epochs)
+        # The latest epoch is still in memory, only the best model has to come from disk
+        model = None if load_best else self.ddp_model.module
+        if load_best:
+            self.checkpoint_writer.flush()
+        test_accuracy_seq = sequence_accuracy(self.config,self.test_ds,self.tgt_itos,load_best, epochs, model=model)
         self.run.log({'test/acc': test_accuracy_seq,
                   'global_step': self.global_step})
         print(f"Test Accuracy: {round(test_accuracy_seq, 4)}")
@@ -537,10 +881,14 @@ class Trainer:
             self.run.define_metric("validation/*", step_metric="global_step")
             self.run.define_metric("train/*", step_metric="global_step")
             self.run.define_metric("test/*", step_metric="global_step")
+            self.run.define_metric("profile/*", step_metric="global_step")
         
         
         if self.current_epoch != 0:
                 self.load_model(epoch=self.current_epoch, lr=self.lr)
+
+        elif self.config.resume_step:
+                self.load_model(step=self.config.resume_step, lr=self.lr)
         
         elif self.resume_best:
                 self.load_model(resume=True, lr=self.lr)
@@ -559,13 +907,16 @@ class Trainer:
             self.train_loss_list.append(round(training_loss, 4))
             self.valid_loss_list.append(round(valid_loss, 4))
 
-            if self.is_master:
-                if valid_loss <= self.best_val_loss:
+            save_best, save_epoch = self._checkpoints_due(valid_loss)
+            if save_best or save_epoch:
+                self._consolidate_optimizer()
+            if self.is_saver:
+                if save_best:
                             self.best_val_loss = valid_loss
                             self._save_model(f"{self.config.model_name}_best.pth")
 
                 if self.save_freq:
-                    if (self.current_epoch+1) % self.save_freq == 0:
+                    if save_epoch:
                         self._save_model(f"{self.config.model_name}_ep{self.current_epoch + 1}.pth")
                         self._test_seq_acc(load_best=False,epochs=self.current_epoch)
 
@@ -577,9 +928,13 @@ class Trainer:
             print(f"Epoch {self.current_epoch + 1}/{self.config.epochs}, "
                   f"Training Loss: {training_loss:.4f}, "
                   f"Validation Loss: {valid_loss:.4f}, ")
-        if self.is_master:
+        if self.save_last:
+            self._consolidate_optimizer()
+        if self.is_saver:
             if self.save_last:
                 self._save_model(f"{self.config.model_name}_ep{self.current_epoch + 1}.pth")
             self._test_seq_acc(load_best=False, epochs=self.current_epoch)
 
+        self.checkpoint_writer.close()
+        self.profiler.close()
         wandb.finish()
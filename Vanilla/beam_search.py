@@ -0,0 +1,111 @@
+import torch
+
+from constants import EOS_IDX
+
+
+class BeamSearch:
+    """
+    Vectorised beam search over a batch of examples.
+
+    All beams of all examples are advanced together, so every decoding step
+    costs a single forward pass over (batch * beam_width) prefixes. Hypotheses
+    are ranked by their length-normalised score ``log_prob / length ** length_penalty``.
+
+    A hypothesis that emits EOS among the top ``beam_width`` candidates of its example
+    is moved to the finished hypotheses of the example, and its beam is given to the next
+    best live candidate, so finished hypotheses are never pushed out by live ones.
+
+    Args:
+        beam_width (int): Number of hypotheses kept per example.
+        max_len (int): Maximum length of the generated sequences, start symbol included.
+        length_penalty (float, optional): Exponent of the length normalisation. Defaults to 1.0.
+        early_stopping (bool, optional): Stop an example as soon as its best finished hypothesis
+            scores at least as well as its best live one, instead of waiting for beam_width
+            finished hypotheses. Defaults to True.
+    """
+
+    def __init__(self, beam_width, max_len, length_penalty=1.0, early_stopping=True):
+        self.beam_width = beam_width
+        self.max_len = max_len
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+
+    def search(self, step_fn, batch_size, start_symbol, device, reorder_fn=None):
+        """
+        Run the search.
+
+        Args:
+            step_fn (callable): Maps the token prefixes of shape (batch * beam_width, cur_len)
+                to next token log-probabilities of shape (batch * beam_width, vocab_size).
+            batch_size (int): Number of examples.
+            start_symbol (int): Start symbol for decoding.
+            device (torch.device): Device of the prefixes.
+            reorder_fn (callable, optional): Called with the flat indices of the surviving
+                beams after every step, so that decoder caches can follow them.
+
+        Returns:
+            list: Best token sequence for every example, up to and including EOS.
+        """
+        k = self.beam_width
+        ys = torch.full((batch_size * k, 1), start_symbol, dtype=torch.long, device=device)
+        scores = torch.zeros(batch_size, k, device=device)
+        # Only the first beam is alive at the start, otherwise all beams would be identical
+        scores[:, 1:] = float('-inf')
+        done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        offsets = (torch.arange(batch_size, device=device) * k).unsqueeze(1)
+        # Finished hypotheses of every example, as (normalised score, tokens)
+        finished = [[] for _ in range(batch_size)]
+        num_finished = torch.zeros(batch_size, dtype=torch.long, device=device)
+        best_finished = torch.full((batch_size,), float('-inf'), device=device)
+
+        for length in range(1, self.max_len):
+            log_probs = step_fn(ys).float()
+            vocab_size = log_probs.size(-1)
+            cand_scores = (scores.unsqueeze(-1) + log_probs.view(batch_size, k, vocab_size)).view(batch_size, -1)
+            # All live beams have the same length, so raw and normalised scores rank alike. At most
+            # k of the 2k best candidates end in EOS, the others are enough to refill every beam.
+            top_scores, top_idx = cand_scores.topk(min(2 * k, cand_scores.size(1)), dim=1)
+            beam_idx = top_idx // vocab_size
+            tokens = top_idx % vocab_size
+            is_eos = tokens == EOS_IDX
+            norm = length ** self.length_penalty
+
+            ranks = torch.arange(top_idx.size(1), device=device).expand_as(top_idx)
+            final = is_eos & (ranks < k) & ~done.unsqueeze(1) & top_scores.isfinite()
+            num_finished += final.sum(dim=1)
+            final_scores = torch.where(final, top_scores / norm, float('-inf'))
+            best_finished = torch.maximum(best_finished, final_scores.max(dim=1).values)
+            examples, final_ranks = final.nonzero(as_tuple=True)
+            prefixes = ys.index_select(0, examples * k + beam_idx[examples, final_ranks])
+            for example, score, prefix in zip(examples.tolist(), final_scores[examples, final_ranks].tolist(),
+                                              prefixes.tolist()):
+                finished[example].append((score, prefix + [EOS_IDX]))
+
+            # The k best candidates that do not end in EOS continue, in score order
+            live = torch.where(is_eos, ranks + top_idx.size(1), ranks).argsort(dim=1)[:, :k]
+            beam_idx = beam_idx.gather(1, live)
+            tokens = tokens.gather(1, live)
+            scores = top_scores.gather(1, live)
+
+            flat_idx = (beam_idx + offsets).view(-1)
+            ys = torch.cat([ys.index_select(0, flat_idx), tokens.view(-1, 1)], dim=1)
+            if reorder_fn is not None:
+                reorder_fn(flat_idx)
+
+            if self.early_stopping:
+                done |= best_finished >= scores[:, 0] / norm
+            else:
+                done |= num_finished >= k
+            if done.all():
+                break
+
+        # Examples still running when max_len is reached also compete with their live beams
+        norm = (ys.size(1) - 1) ** self.length_penalty
+        sequences = []
+        live_scores = (scores / norm).tolist()
+        for example, (hypotheses, is_done) in enumerate(zip(finished, done.tolist())):
+            if not is_done:
+                hypotheses.extend((score, row) for score, row in zip(live_scores[example], ys[example * k:(example + 1) * k].tolist())
+                                  if score != float('-inf'))
+            sequences.append(max(hypotheses, key=lambda hypothesis: hypothesis[0])[1])
+        return sequences
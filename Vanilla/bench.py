@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+
+from config import TransformerTestConfig
+from constants import SPECIAL_SYMBOLS
+from fn_utils import create_mask, get_model
+from trainer import Predictor
+
+DTYPES = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+PERCENTILES = (50, 90, 99)
+
+
+def peak_rss_mib():
+    """Peak RSS of the process so far."""
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def peak_memory_mib(device, baseline_mib=0.0):
+    """Peak CUDA memory allocated since the last reset, or peak process RSS above a baseline on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return peak_rss_mib() - baseline_mib
+
+
+class Timer:
+    """Wall-clock timer that waits for queued CUDA work before reading the clock."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+
+def summarize(times, tokens):
+    """Latency percentiles in milliseconds and throughput of one phase."""
+    times = np.asarray(times)
+    summary = {f"p{q}_ms": float(np.percentile(times, q) * 1e3) for q in PERCENTILES}
+    summary['tokens_per_sec'] = float(tokens / times.mean())
+    return summary
+
+
+def build_config(args, hidden_dim, seq_len):
+    """Test config describing the benchmarked model."""
+    return TransformerTestConfig(
+        model_name='bench',
+        root_dir='.',
+        data_dir='.',
+        device=args.device,
+        embedding_size=args.embedding_size,
+        hidden_dim=hidden_dim,
+        nhead=args.nhead,
+        num_encoder_layers=args.num_encoder_layers,
+        num_decoder_layers=args.num_decoder_layers,
+        dropout=args.dropout,
+        src_max_len=seq_len,
+        tgt_max_len=seq_len,
+        src_voc_size=args.voc_size,
+        tgt_voc_size=args.voc_size,
+    )
+
+
+def bench_case(args, batch_size, seq_len, hidden_dim, dtype_name):
+    """
+    Benchmark one configuration.
+
+    Returns:
+        dict: Settings and per-phase measurements of the configuration.
+    """
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    # On CPU the case runs in a fresh process, whose peak RSS so far is the cost of the imports
+    baseline_mib = peak_rss_mib()
+    config = build_config(args, hidden_dim, seq_len)
+    model = get_model(config).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = torch.nn.CrossEntropyLoss()
+    dtype = DTYPES[dtype_name]
+    autocast = (torch.autocast(device_type=device.type, dtype=dtype) if dtype != torch.float32
+                else contextlib.nullcontext())
+
+    generator = torch.Generator().manual_seed(args.seed)
+    low = len(SPECIAL_SYMBOLS)
+    # Sequence-first layout, the target holds seq_len inputs plus the shifted label
+    src = torch.randint(low, args.voc_size, (seq_len, batch_size), generator=generator).to(device)
+    tgt = torch.randint(low, args.voc_size, (seq_len + 1, batch_size), generator=generator).to(device)
+    tgt_input, tgt_out = tgt[:-1, :], tgt[1:, :]
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    timer = Timer(device)
+    phases = {'forward': [], 'backward': [], 'optimizer': [], 'decode': []}
+
+    model.train()
+    for i in range(args.warmup + args.iters):
+        start = timer.now()
+        with autocast:
+            src_mask, tgt_mask, src_padding_mask, tgt_padding_mask = create_mask(src, tgt_input, device)
+            logits = model(src, tgt_input, src_mask, tgt_mask, src_padding_mask, tgt_padding_mask, src_padding_mask)
+            loss = criterion(logits.reshape(-1, logits.shape[-1]), tgt_out.reshape(-1))
+        forward_end = timer.now()
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        backward_end = timer.now()
+        optimizer.step()
+        step_end = timer.now()
+        if i >= args.warmup:
+            phases['forward'].append(forward_end - start)
+            phases['backward'].append(backward_end - forward_end)
+            phases['optimizer'].append(step_end - backward_end)
+
+    predictor = Predictor(config, model=model)
+    # The decoder loop runs max_len steps after the start symbol
+    predictor.max_len = args.decode_len - 1
+    for i in range(args.decode_warmup + args.decode_iters):
+        start = timer.now()
+        with autocast:
+            predictor.predict_batch(src)
+        if i >= args.decode_warmup:
+            phases['decode'].append(timer.now() - start)
+
+    train_tokens = batch_size * 2 * seq_len
+    result = {
+        'model': 'transformer', 'device': device.type, 'batch_size': batch_size, 'seq_len': seq_len,
+        'hidden_dim': hidden_dim, 'dtype': dtype_name,
+        'peak_memory_mib': peak_memory_mib(device, baseline_mib),
+    }
+    for phase in ('forward', 'backward', 'optimizer'):
+        result.update({f"{phase}_{key}": value for key, value in summarize(phases[phase], train_tokens).items()})
+    train_step = np.sum([phases[phase] for phase in ('forward', 'backward', 'optimizer')], axis=0)
+    result.update({f"train_step_{key}": value for key, value in summarize(train_step, train_tokens).items()})
+    # Decoding always runs the full decode_len steps, a randomly initialised model rarely emits EOS
+    decode_tokens = batch_size * (args.decode_len - 1)
+    result.update({f"decode_{key}": value for key, value in summarize(phases['decode'], decode_tokens).items()})
+    return result
+
+
+def write_results(results, path):
+    """Write results as JSON or CSV, depending on the file extension."""
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(',')]
+
+
+def parse_args():
+    """Parses command-line arguments for the Transformer benchmark."""
+    parser = argparse.ArgumentParser(description="Transformer Throughput/Latency Benchmark")
+
+    # Sweeps
+    parser.add_argument('--batch_sizes', type=parse_list, default=[8], help='Batch sizes (comma-separated)')
+    parser.add_argument('--seq_lens', type=parse_list, default=[64], help='Source/target lengths (comma-separated)')
+    parser.add_argument('--hidden_dims', type=parse_list, default=[512], help='Feed-forward dimensions (comma-separated)')
+    parser.add_argument('--dtypes', type=lambda value: parse_list(value, str), default=['float32'],
+                        help=f"Autocast dtypes (comma-separated, from {', '.join(DTYPES)})")
+
+    # Model Architecture
+    parser.add_argument('--embedding_size', type=int, default=128, help='Embedding dimensions')
+    parser.add_argument('--nhead', type=int, default=4, help='Transformer attention heads')
+    parser.add_argument('--num_encoder_layers', type=int, default=2, help='Number of encoder layers')
+    parser.add_argument('--num_decoder_layers', type=int, default=2, help='Number of decoder layers')
+    parser.add_argument('--dropout', type=float, default=0.1, help='Dropout probability')
+    parser.add_argument('--voc_size', type=int, default=1000, help='Source and target vocabulary size')
+
+    # Measurement
+    parser.add_argument('--device', type=str, default='cpu', help='Benchmark device')
+    parser.add_argument('--iters', type=int, default=10, help='Timed training iterations')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed training iterations')
+    parser.add_argument('--decode_len', type=int, default=32, help='Decoded sequence length, start symbol included')
+    parser.add_argument('--decode_iters', type=int, default=3, help='Timed decoding runs')
+    parser.add_argument('--decode_warmup', type=int, default=1, help='Untimed decoding runs')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the random inputs')
+    parser.add_argument('--output', type=str, default=None, help='Write results to a .json or .csv file')
+    return parser.parse_args()
+
+
+def run_case(args, *case):
+    """
+    Benchmark one configuration, on CPU in a fresh process.
+
+    The CPU peak memory is read from the process peak RSS, which never goes down, so every
+    case gets a process of its own instead of inheriting the peak of the previous ones.
+    """
+    if torch.device(args.device).type == 'cuda':
+        return bench_case(args, *case)
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(bench_case, (args,) + case)
+
+
+def main(args):
+    results = []
+    for batch_size, seq_len, hidden_dim, dtype_name in itertools.product(
+            args.batch_sizes, args.seq_lens, args.hidden_dims, args.dtypes):
+        result = run_case(args, batch_size, seq_len, hidden_dim, dtype_name)
+        results.append(result)
+        print(f"bs={batch_size} len={seq_len} hidden_dim={hidden_dim} {dtype_name}: "
+              f"train {result['train_step_tokens_per_sec']:.0f} tok/s (p50 {result['train_step_p50_ms']:.1f} ms), "
+              f"decode {result['decode_tokens_per_sec']:.0f} tok/s (p50 {result['decode_p50_ms']:.1f} ms), "
+              f"peak {result['peak_memory_mib']:.0f} MiB")
+    if args.output:
+        write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main(parse_args())
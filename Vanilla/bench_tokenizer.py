@@ -0,0 +1,95 @@
+import argparse
+import glob
+import re
+import time
+
+import pandas as pd
+
+from constants import SPECIAL_SYMBOLS, UNK_IDX
+from tokenizer import Tokenizer
+
+# Multi-pass tokenizer the single-pass splitters replaced, kept as the parity reference
+OPERATORS = {
+    '+': re.compile(r'\+'), '-': re.compile(r'-'), '*': re.compile(r'\*'),
+    ',': re.compile(r','), '^': re.compile(r'\^'), '%': re.compile(r'%'),
+    '}': re.compile(r'\}'), '(': re.compile(r'\('), ')': re.compile(r'\)')
+}
+UNDERSCORE_CURLY = re.compile(r'\b\w+_{')
+TGT_PATTERNS = [re.compile(r'\b\w+_\d{1}\b'), re.compile(r'\b\w+_\w\b'), re.compile(r'\b\w+_\d{2,}\b')]
+
+
+def reference_src_tokenize(tokenizer, ampl, seed):
+    temp_ampl = tokenizer.src_replace(ampl, seed) if tokenizer.to_replace else ampl
+    temp_ampl = temp_ampl.replace('\\\\', '\\').replace('\\', ' \\ ').replace('%', '')
+    temp_ampl = UNDERSCORE_CURLY.sub(lambda match: f' {match.group(0)} ', temp_ampl)
+    for symbol, pattern in OPERATORS.items():
+        temp_ampl = pattern.sub(f' {symbol} ', temp_ampl)
+    temp_ampl = re.sub(r' {2,}', ' ', temp_ampl)
+    return [token for token in temp_ampl.split(' ') if token]
+
+
+def reference_tgt_tokenize(tokenizer, sqampl):
+    temp_sqampl = tokenizer.remove_whitespace(sqampl)
+    for symbol, pattern in OPERATORS.items():
+        temp_sqampl = pattern.sub(f' {symbol} ', temp_sqampl)
+    for pattern in TGT_PATTERNS:
+        temp_sqampl = pattern.sub(lambda match: f' {match.group(0)} ', temp_sqampl)
+    temp_sqampl = re.sub(r' {2,}', ' ', temp_sqampl)
+    return [token for token in temp_sqampl.split(' ') if token]
+
+
+def check_parity(tokenizer, amps, sqamps, seed):
+    """Number of expressions whose tokens differ from the reference."""
+    mismatches = 0
+    for amp in amps:
+        mismatches += tokenizer.src_tokenize(amp, seed) != reference_src_tokenize(tokenizer, amp, seed)
+    for sqamp in sqamps:
+        mismatches += tokenizer.tgt_tokenize(sqamp) != reference_tgt_tokenize(tokenizer, sqamp)
+    return mismatches
+
+
+def time_tokenize(src_fn, tgt_fn, amps, sqamps, seed, repeats):
+    """Best wall time over the repeats and the number of tokens produced per pass."""
+    best, num_tokens = float('inf'), 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        num_tokens = sum(len(src_fn(amp, seed)) for amp in amps) + sum(len(tgt_fn(sqamp)) for sqamp in sqamps)
+        best = min(best, time.perf_counter() - start)
+    return best, num_tokens
+
+
+def parse_args():
+    """Parses command-line arguments for the tokenizer benchmark."""
+    parser = argparse.ArgumentParser(description="Tokenizer throughput benchmark and parity check")
+    parser.add_argument('--data', type=str, default='../Data/*.csv', help='Glob of CSV files with amp/sqamp columns')
+    parser.add_argument('--to_replace', type=bool, default=False, help='Replace indices and momenta')
+    parser.add_argument('--seed', type=int, default=42, help='Replacement seed')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes, the best one is reported')
+    return parser.parse_args()
+
+
+def main(args):
+    df = pd.concat([pd.read_csv(path) for path in sorted(glob.glob(args.data))], ignore_index=True)
+    amps, sqamps = df.amp.tolist(), df.sqamp.tolist()
+
+    mismatches = check_parity(Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, args.to_replace),
+                              amps, sqamps, args.seed)
+    print(f"{len(amps)} expression pairs, {mismatches} mismatches against the reference tokenizer")
+
+    reference = Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, args.to_replace)
+    uncached = Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, args.to_replace, memo_size=0)
+    cached = Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, args.to_replace, memo_size=2 * len(amps))
+    cases = {
+        'reference': (lambda amp, seed: reference_src_tokenize(reference, amp, seed),
+                      lambda sqamp: reference_tgt_tokenize(reference, sqamp)),
+        'single-pass': (uncached.src_tokenize, uncached.tgt_tokenize),
+        # The first pass fills the memo, the best pass is all hits
+        'memoised': (cached.src_tokenize, cached.tgt_tokenize),
+    }
+    for name, (src_fn, tgt_fn) in cases.items():
+        seconds, num_tokens = time_tokenize(src_fn, tgt_fn, amps, sqamps, args.seed, args.repeats)
+        print(f"{name:<12} {num_tokens / seconds:>12.0f} tokens/s ({seconds * 1e3:.1f} ms per pass)")
+
+
+if __name__ == '__main__':
+    main(parse_args())
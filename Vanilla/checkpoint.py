@@ -0,0 +1,121 @@
+import os
+import queue
+import threading
+
+import torch
+
+
+def _snapshot(obj, pin_memory):
+    """Copy every tensor of a (nested) state dict to the CPU, device copies are asynchronous."""
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        copy = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=pin_memory)
+        copy.copy_(obj.detach(), non_blocking=pin_memory)
+        return copy
+    if isinstance(obj, dict):
+        return type(obj)((key, _snapshot(value, pin_memory)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(value, pin_memory) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread.
+
+    ``save`` only snapshots the state to (pinned) CPU memory and returns, training carries on
+    while a worker thread serialises the snapshot. Every file is written to a temporary path
+    and renamed into place, so a crash mid-write never leaves a truncated checkpoint behind.
+    Rotated checkpoints are tracked in ``ckp_paths`` and the oldest is deleted once there
+    are more than ``save_limit``. A file can instead replace a single earlier one, which is
+    deleted once the new file is in place.
+
+    Errors of the worker are raised by the next ``save``, ``flush`` or ``close``.
+
+    Args:
+        ckp_paths (list): Paths of existing rotated checkpoints, oldest first.
+        save_limit (int): Number of rotated checkpoints to keep.
+    """
+
+    def __init__(self, ckp_paths, save_limit):
+        self.ckp_paths = ckp_paths
+        self.save_limit = save_limit
+        self.pin_memory = torch.cuda.is_available()
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, rotate=True, replaces=None):
+        """
+        Snapshot a checkpoint and queue it for writing.
+
+        Args:
+            state (dict): Checkpoint, tensors may live on any device.
+            path (str): Destination file.
+            rotate (bool, optional): Whether the file takes part in the save_limit rotation. Defaults to True.
+            replaces (str, optional): Earlier file to delete once this one is written. Defaults to None.
+        """
+        self._raise_error()
+        snapshot = _snapshot(state, self.pin_memory)
+        event = None
+        if self.pin_memory:
+            # The worker waits for the copies, later kernels cannot change them on the same stream
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((snapshot, event, path, rotate, replaces))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self._write(*item)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot, event, path, rotate, replaces):
+        if event is not None:
+            event.synchronize()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            torch.save(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        if replaces is not None and replaces != path and os.path.exists(replaces):
+            os.remove(replaces)
+
+        if rotate:
+            if path in self.ckp_paths:
+                self.ckp_paths.remove(path)
+            self.ckp_paths.append(path)
+            # Remove oldest checkpoint if exceeding save_limit
+            while len(self.ckp_paths) > self.save_limit:
+                oldest_checkpoint = self.ckp_paths.pop(0)
+                if os.path.exists(oldest_checkpoint):
+                    os.remove(oldest_checkpoint)
+                    print(f"Deleted old checkpoint: {oldest_checkpoint}")
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def flush(self):
+        """Wait until every queued checkpoint is on disk."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Flush the queued checkpoints and stop the worker."""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
@@ -71,8 +71,16 @@ class TransformerConfig:
     update_lr: Optional[float] = None  # New learning rate (if updated)
     end_lr: Optional[float] = 1e-8  # Minimum learning rate
     clip_grad_norm: Optional[float] = -1  # Gradient clipping (-1 disables)
+    grad_accum_steps: int = 1  # Micro-batches accumulated per optimizer step
+    ddp_bucket_cap_mb: int = 25  # DDP gradient bucket size in MiB
+    gradient_as_bucket_view: bool = False  # Let gradients alias the DDP buckets instead of copying them
+    zero_optimizer: bool = False  # Shard the optimizer state across ranks (ZeRO-1)
     log_freq: Optional[int] = 50  # Steps per log entry
     test_freq: Optional[int] = 10  # Steps per test run
+    test_batch_size: Optional[int] = 64  # Batch size for sequence accuracy decoding
+    beam_width: int = 1  # Beam width for decoding (1 for greedy)
+    length_penalty: float = 1.0  # Length normalisation exponent for beam search
+    early_stopping: bool = True  # Stop an example once its best finished hypothesis outscores its live beams
     truncate: Optional[bool] = False  # Whether to truncate sequences
     debug: Optional[bool] = False  # Enable debug mode
 
@@ -80,6 +88,24 @@ class TransformerConfig:
     to_replace: bool = False  # Replace index/momentum terms
     index_pool_size: int = 100  # Index token pool size
     momentum_pool_size: int = 100  # Momentum token pool size
+    vocab_workers: int = 0  # Processes building the vocabularies (0: all cores)
+    stream_data: bool = False  # Read the splits chunk by chunk instead of into memory (implies use_token_cache)
+    ingest_chunk_size: int = 100000  # Rows per chunk when streaming the splits
+    use_token_cache: bool = False  # Read pre-tokenised ids from a memory-mapped cache
+    token_cache_dir: Optional[str] = None  # Token cache directory (default: root_dir/token_cache)
+    iterable_data: bool = False  # Stream train batches from token cache shards of each (rank, worker) pair (implies stream_data)
+    shard_size: int = 10000  # Samples per token cache shard with iterable_data
+    shuffle_buffer: int = 10000  # Samples in the shuffle buffer with iterable_data
+    save_steps: int = 0  # Save a resumable mid-epoch checkpoint every N optimizer steps (0: off)
+    resume_step: int = 0  # Resume from the mid-epoch checkpoint saved at this step
+    bucket_batches: bool = False  # Batch sequences of similar length
+    bucket_size_multiplier: int = 100  # Length bucket size in batches
+    max_tokens: Optional[int] = None  # Token budget per batch, replaces the batch sizes
+    profile: bool = False  # Time data loading, forward, backward and optimizer phases
+    profile_window: int = 100  # Steps the profiled percentiles are taken over
+    profile_trace_dir: Optional[str] = None  # Write a torch.profiler trace to this directory
+    profile_trace_start: int = 10  # First traced step
+    profile_trace_steps: int = 5  # Number of traced steps
 
     def to_dict(self):
         """Convert configuration to a dictionary."""
@@ -144,5 +170,17 @@ class TransformerTestConfig:
     # trucate sequences
     truncate: Optional[bool]= False
 
+    # Batch size for sequence accuracy decoding
+    test_batch_size: Optional[int] = 64
+
+    # Beam search (a beam width of 1 decodes greedily)
+    beam_width: int = 1
+    length_penalty: float = 1.0
+    early_stopping: bool = True
+
+    # Pre-tokenised dataset cache (defaults to root_dir/token_cache)
+    use_token_cache: bool = False
+    token_cache_dir: Optional[str] = None
+
     def to_dict(self):
         return asdict(self)
\ No newline at end of file
@@ -1,20 +1,26 @@
 from torch.utils.data import Dataset
+import numpy as np
 import torch
+from tqdm import tqdm
 
 from constants import BOS_IDX, PAD_IDX, EOS_IDX
+from token_cache import build_token_caches
 
 class Data(Dataset):
     """
     Custom PyTorch dataset for handling data.
 
     Args:
-        df (DataFrame): DataFrame containing data.
+        df (DataFrame or StreamingCorpus): Data, a StreamingCorpus is only read through token_cache.
+        token_cache (TokenCache, optional): Pre-tokenised ids of the same rows, read instead of tokenizing.
     """
 
-    def __init__(self, df, tokenizer, config, src_vocab, tgt_vocab):
+    def __init__(self, df, tokenizer, config, src_vocab, tgt_vocab, token_cache=None):
         super(Data, self).__init__()
-        self.tgt_vals = df['sqamp']
-        self.src_vals = df['amp']
+        # Cached splits never read the raw expressions, so the DataFrame columns are not kept
+        self.tgt_vals = df['sqamp'] if token_cache is None else None
+        self.src_vals = df['amp'] if token_cache is None else None
+        self.token_cache = token_cache
         self.tgt_tokenize = tokenizer.tgt_tokenize
         self.src_tokenize = tokenizer.src_tokenize
         self.bos_token = torch.tensor([BOS_IDX], dtype=torch.int64)
@@ -31,8 +37,30 @@ class Data(Dataset):
         Returns:
             int: Length of the dataset.
         """
+        if self.token_cache is not None:
+            return len(self.token_cache)
         return len(self.src_vals)
 
+    def lengths(self):
+        """
+        Get the source and target lengths of all samples, special tokens included.
+
+        Lengths are read from the token cache offsets when available, otherwise every
+        sample is tokenized once.
+
+        Returns:
+            ndarray: Array of shape (num_samples, 2) with source and target lengths.
+        """
+        if self.token_cache is not None:
+            src_lengths, tgt_lengths = self.token_cache.lengths()
+        else:
+            src_lengths = np.array([len(self.src_tokenize(src, self.config.seed))
+                                    for src in tqdm(self.src_vals, desc='Measuring lengths')])
+            tgt_lengths = np.array([len(self.tgt_tokenize(tgt)) for tgt in self.tgt_vals])
+        src_lengths = np.minimum(src_lengths + 2, self.config.src_max_len)
+        tgt_lengths = np.minimum(tgt_lengths + 2, self.config.tgt_max_len)
+        return np.stack([src_lengths, tgt_lengths], axis=1)
+
     def __getitem__(self, idx):
         """
         Get an item from the dataset at the specified index.
@@ -43,10 +71,13 @@ class Data(Dataset):
         Returns:
             tuple: Tuple containing source and target tensors.
         """
-        src_tokenized = self.src_tokenize(self.src_vals[idx],self.config.seed)
-        tgt_tokenized = self.tgt_tokenize(self.tgt_vals[idx])
-        src_ids = self.src_vocab(src_tokenized)
-        tgt_ids = self.tgt_vocab(tgt_tokenized)
+        if self.token_cache is not None:
+            src_ids, tgt_ids = self.token_cache.get(idx)
+        else:
+            src_tokenized = self.src_tokenize(self.src_vals[idx],self.config.seed)
+            tgt_tokenized = self.tgt_tokenize(self.tgt_vals[idx])
+            src_ids = self.src_vocab(src_tokenized)
+            tgt_ids = self.tgt_vocab(tgt_tokenized)
 
         enc_num_padding_tokens = self.config.src_max_len - len(src_ids) - 2
         dec_num_padding_tokens = self.config.tgt_max_len - len(tgt_ids) - 2
@@ -88,8 +119,16 @@ class Data(Dataset):
         Returns:
             dict: Dictionary containing train, test, and valid datasets.
         """
-        train = Data(df_train, tokenizer, config,src_vocab,tgt_vocab)
-        test = Data(df_test, tokenizer, config,src_vocab,tgt_vocab)
-        valid = Data(df_valid, tokenizer, config,src_vocab,tgt_vocab)
+        caches = {}
+        if config.use_token_cache:
+            caches = build_token_caches({'train': df_train, 'test': df_test, 'valid': df_valid},
+                                        config, tokenizer, src_vocab, tgt_vocab)
+
+        train = Data(df_train, tokenizer, config,src_vocab,tgt_vocab, caches.get('train'))
+        # Ranks that never evaluate sequence accuracy may not read the test split
+        test = None
+        if df_test is not None or 'test' in caches:
+            test = Data(df_test, tokenizer, config,src_vocab,tgt_vocab, caches.get('test'))
+        valid = Data(df_valid, tokenizer, config,src_vocab,tgt_vocab, caches.get('valid'))
 
         return {'train': train, 'test': test, 'valid': valid}
\ No newline at end of file
@@ -1,5 +1,9 @@
 import argparse
+import hashlib
+import json
+import os
 import random
+from collections import OrderedDict
 from datetime import timedelta
 from typing import List
 
@@ -7,25 +11,139 @@ import torch
 import torch.distributed as dist
 import torch.nn as nn
 from torch.nn.utils.rnn import pad_sequence
+from torchtext.vocab import vocab
 
 from config import TransformerConfig
 from constants import BOS_IDX, EOS_IDX, PAD_IDX, SPECIAL_SYMBOLS, UNK_IDX
+from ingest import StreamingCorpus, iter_chunks
 from model import Model
 from prefix_tokenizer import PrefixTokenizer
 from tokenizer import Tokenizer
 
 def create_tokenizer(df, config, index_pool_size, momentum_pool_size):
-    """Create a tokenizer and build source and target vocabularies."""
+    """
+    Create a tokenizer and source and target vocabularies.
 
-    tokenizer = Tokenizer(df, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX, config.to_replace)
+    Vocabularies are persisted next to the checkpoints and reused as long as the data
+    and tokenizer settings they were built from are unchanged.
+    """
     
-    src_vocab = tokenizer.build_src_vocab(config.seed)
+    streaming = isinstance(df, StreamingCorpus)
+    tokenizer = Tokenizer(None if streaming else df, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX,
+                          config.to_replace)
+
+    settings = tokenizer_settings(config, index_pool_size, momentum_pool_size)
+    key = content_hash(df, settings)
+    vocab_path = os.path.join(config.root_dir, f"{config.model_name}_vocab.json")
+    vocabs = load_vocab(vocab_path, key)
+    if vocabs is not None:
+        src_vocab, tgt_vocab = vocabs
+        print(f"Loaded vocabularies from {vocab_path}")
+    elif streaming:
+        # One pass over the files counts both sides, chunk by chunk
+        src_counter, tgt_counter = tokenizer.count_chunk_tokens(df.chunks(), config.seed, config.vocab_workers)
+        src_vocab, tgt_vocab = tokenizer.vocab_from_counter(src_counter), tokenizer.vocab_from_counter(tgt_counter)
+        save_vocab(vocab_path, key, settings, src_vocab, tgt_vocab)
+    else:
+        src_vocab = tokenizer.build_src_vocab(config.seed, config.vocab_workers)
+        tgt_vocab = tokenizer.build_tgt_vocab(config.vocab_workers)
+        save_vocab(vocab_path, key, settings, src_vocab, tgt_vocab)
+
     src_itos = {value: key for key, value in src_vocab.get_stoi().items()}
-    tgt_vocab = tokenizer.build_tgt_vocab()
     tgt_itos = {value: key for key, value in tgt_vocab.get_stoi().items()}
 
     return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
 
+def create_shared_tokenizer(df, config, index_pool_size, momentum_pool_size):
+    """
+    Create the tokenizer and vocabularies on the first rank and share them with the others.
+
+    Only the first rank needs the concatenated DataFrame; the other ranks may pass None and
+    receive the vocabularies through an object broadcast instead of re-tokenizing the corpus.
+    """
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+        return create_tokenizer(df, config, index_pool_size, momentum_pool_size)
+
+    # Object collectives pickle through CPU tensors, so they run on a gloo group
+    group = dist.new_group(backend='gloo')
+    rank = dist.get_rank()
+    if rank == 0:
+        tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos = create_tokenizer(df, config, index_pool_size,
+                                                                               momentum_pool_size)
+        payload = [src_vocab.get_itos(), tgt_vocab.get_itos()]
+    else:
+        payload = [None, None]
+    dist.broadcast_object_list(payload, src=0, group=group)
+    dist.destroy_process_group(group)
+
+    if rank == 0:
+        return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
+
+    tokenizer = Tokenizer(None, index_pool_size, momentum_pool_size, SPECIAL_SYMBOLS, UNK_IDX, config.to_replace)
+    src_vocab, tgt_vocab = vocab_from_itos(payload[0]), vocab_from_itos(payload[1])
+    src_itos = dict(enumerate(payload[0]))
+    tgt_itos = dict(enumerate(payload[1]))
+    return tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos
+
+def tokenizer_settings(config, index_pool_size, momentum_pool_size):
+    """Settings that determine the token stream of an expression."""
+    return {
+        'to_replace': config.to_replace,
+        'index_pool_size': index_pool_size,
+        'momentum_pool_size': momentum_pool_size,
+        'seed': config.seed,
+        'special_symbols': SPECIAL_SYMBOLS,
+    }
+
+def content_hash(df, settings, vocabs=()):
+    """
+    Hash the expressions of a DataFrame together with the settings and vocabularies derived from them.
+
+    A StreamingCorpus is read one column at a time and hashes like the DataFrame of its rows.
+    """
+    digest = hashlib.sha256()
+    for column in ('amp', 'sqamp'):
+        for chunk in iter_chunks(df, (column,)):
+            for expr in chunk[column]:
+                digest.update(expr.encode())
+                digest.update(b'\0')
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    for voc in vocabs:
+        digest.update('\0'.join(voc.get_itos()).encode())
+        digest.update(b'\1')
+    return digest.hexdigest()[:16]
+
+def vocab_from_itos(itos):
+    """Rebuild a vocabulary from its index-to-token list."""
+    voc = vocab(OrderedDict((token, 1) for token in itos))
+    voc.set_default_index(UNK_IDX)
+    return voc
+
+def save_vocab(path, key, settings, src_vocab, tgt_vocab):
+    """Persist vocabularies and the tokenizer settings they were built with."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    artifacts = {
+        'hash': key,
+        'tokenizer': settings,
+        'src_itos': src_vocab.get_itos(),
+        'tgt_itos': tgt_vocab.get_itos(),
+    }
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(artifacts, f)
+    os.replace(tmp_path, path)
+
+def load_vocab(path, key):
+    """Load persisted vocabularies, or return None if they are missing or stale."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        artifacts = json.load(f)
+    if artifacts['hash'] != key:
+        print(f"Vocabularies in {path} are stale, rebuilding")
+        return None
+    return vocab_from_itos(artifacts['src_itos']), vocab_from_itos(artifacts['tgt_itos'])
+
 def init_distributed_mode(config):
     """Initialize the distributed processing mode."""
     dist.init_process_group(backend=config.backend, timeout=timedelta(minutes=30))
@@ -217,8 +335,16 @@ def parse_args():
     parser.add_argument("--update_lr", type=float, default=None, help="Updated learning rate")
     parser.add_argument("--end_lr", type=float, default=1e-8, help="Final learning rate")
     parser.add_argument("--clip_grad_norm", type=float, default=-1, help="Gradient clipping threshold (-1 to disable)")
+    parser.add_argument("--grad_accum_steps", type=int, default=1, help="Micro-batches accumulated per optimizer step")
+    parser.add_argument("--ddp_bucket_cap_mb", type=int, default=25, help="DDP gradient bucket size in MiB")
+    parser.add_argument("--gradient_as_bucket_view", type=bool, default=False, help="Let gradients alias the DDP buckets instead of copying them")
+    parser.add_argument("--zero_optimizer", type=bool, default=False, help="Shard the optimizer state across ranks (ZeRO-1)")
     parser.add_argument("--log_freq", type=int, default=50, help="Logging frequency (steps)")
     parser.add_argument("--test_freq", type=int, default=10, help="Testing frequency (steps)")
+    parser.add_argument("--test_batch_size", type=int, default=64, help="Batch size for sequence accuracy decoding")
+    parser.add_argument("--beam_width", type=int, default=1, help="Beam width for decoding (1 for greedy)")
+    parser.add_argument("--length_penalty", type=float, default=1.0, help="Length normalisation exponent for beam search")
+    parser.add_argument("--early_stopping", type=bool, default=True, help="Stop an example once its best finished hypothesis outscores its live beams")
     parser.add_argument("--truncate", type=bool, default=False, help="Truncate sequences")
     parser.add_argument("--debug", type=bool, default=False, help="Enable debug mode")
 
@@ -226,6 +352,24 @@ def parse_args():
     parser.add_argument("--to_replace", type=bool, default=False, help="Replace index and momentum terms")
     parser.add_argument("--index_pool_size", type=int, default=100, help="Index token pool size")
     parser.add_argument("--momentum_pool_size", type=int, default=100, help="Momentum token pool size")
+    parser.add_argument("--vocab_workers", type=int, default=0, help="Processes building the vocabularies (0: all cores)")
+    parser.add_argument("--stream_data", type=bool, default=False, help="Read the splits chunk by chunk instead of into memory (implies use_token_cache)")
+    parser.add_argument("--ingest_chunk_size", type=int, default=100000, help="Rows per chunk when streaming the splits")
+    parser.add_argument("--use_token_cache", type=bool, default=False, help="Read pre-tokenised ids from a memory-mapped cache")
+    parser.add_argument("--token_cache_dir", type=str, default=None, help="Token cache directory (default: root_dir/token_cache)")
+    parser.add_argument("--iterable_data", type=bool, default=False, help="Stream train batches from token cache shards of each (rank, worker) pair (implies stream_data)")
+    parser.add_argument("--shard_size", type=int, default=10000, help="Samples per token cache shard with iterable_data")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000, help="Samples in the shuffle buffer with iterable_data")
+    parser.add_argument("--save_steps", type=int, default=0, help="Save a resumable mid-epoch checkpoint every N optimizer steps (0: off)")
+    parser.add_argument("--resume_step", type=int, default=0, help="Resume from the mid-epoch checkpoint saved at this step")
+    parser.add_argument("--bucket_batches", type=bool, default=False, help="Batch sequences of similar length")
+    parser.add_argument("--bucket_size_multiplier", type=int, default=100, help="Length bucket size in batches")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Token budget per batch, replaces the batch sizes")
+    parser.add_argument("--profile", type=bool, default=False, help="Time data loading, forward, backward and optimizer phases")
+    parser.add_argument("--profile_window", type=int, default=100, help="Steps the profiled percentiles are taken over")
+    parser.add_argument("--profile_trace_dir", type=str, default=None, help="Write a torch.profiler trace to this directory")
+    parser.add_argument("--profile_trace_start", type=int, default=10, help="First traced step")
+    parser.add_argument("--profile_trace_steps", type=int, default=5, help="Number of traced steps")
 
     return parser.parse_args()
 
@@ -267,15 +411,41 @@ def create_config_from_args(args):
         tgt_voc_size=args.tgt_voc_size,
         save_freq=args.save_freq,
         test_freq = args.test_freq,
+        test_batch_size=args.test_batch_size,
+        beam_width=args.beam_width,
+        length_penalty=args.length_penalty,
+        early_stopping=args.early_stopping,
         save_limit=args.save_limit,
         seed=args.seed,
         update_lr=args.update_lr,
         end_lr=args.end_lr,
         clip_grad_norm=args.clip_grad_norm,
+        grad_accum_steps=args.grad_accum_steps,
+        ddp_bucket_cap_mb=args.ddp_bucket_cap_mb,
+        gradient_as_bucket_view=args.gradient_as_bucket_view,
+        zero_optimizer=args.zero_optimizer,
         save_last=args.save_last,
         log_freq=args.log_freq,
         debug=args.debug,
         to_replace=args.to_replace,
         index_pool_size=args.index_pool_size,
-        momentum_pool_size=args.momentum_pool_size
+        momentum_pool_size=args.momentum_pool_size,
+        vocab_workers=args.vocab_workers,
+        stream_data=args.stream_data,
+        ingest_chunk_size=args.ingest_chunk_size,
+        use_token_cache=args.use_token_cache,
+        token_cache_dir=args.token_cache_dir,
+        iterable_data=args.iterable_data,
+        shard_size=args.shard_size,
+        shuffle_buffer=args.shuffle_buffer,
+        save_steps=args.save_steps,
+        resume_step=args.resume_step,
+        bucket_batches=args.bucket_batches,
+        bucket_size_multiplier=args.bucket_size_multiplier,
+        max_tokens=args.max_tokens,
+        profile=args.profile,
+        profile_window=args.profile_window,
+        profile_trace_dir=args.profile_trace_dir,
+        profile_trace_start=args.profile_trace_start,
+        profile_trace_steps=args.profile_trace_steps
     )
\ No newline at end of file
@@ -2,7 +2,8 @@ import torchtext; torchtext.disable_torchtext_deprecation_warning()
 import pandas as pd
 import numpy as np
 import random
-from fn_utils import create_config_from_args, create_tokenizer, init_distributed_mode,  parse_args
+from fn_utils import create_config_from_args, create_shared_tokenizer, init_distributed_mode,  parse_args
+from ingest import StreamingCorpus, load_split
 import torch
 from trainer import Trainer
 import os
@@ -32,22 +33,52 @@ if __name__ == '__main__':
 
     init_distributed_mode(config)
 
-    df_train = pd.read_csv(config.data_dir+"train.csv")
-    df_test = pd.read_csv(config.data_dir+"test.csv")
-    df_valid = pd.read_csv(config.data_dir+"valid.csv")
+    # Sharded training batches come from the token cache, so no split is ever loaded whole
+    if config.iterable_data:
+        config.stream_data = True
 
-    df = pd.concat([df_train,df_valid,df_test]).reset_index(drop=True)
+    if config.stream_data:
+        # The splits stay on disk and are only ever scanned, batches come from the token cache
+        config.use_token_cache = True
+        df_train = StreamingCorpus.from_splits(config.data_dir, ["train"], config.ingest_chunk_size)
+        df_test = StreamingCorpus.from_splits(config.data_dir, ["test"], config.ingest_chunk_size)
+        df_valid = StreamingCorpus.from_splits(config.data_dir, ["valid"], config.ingest_chunk_size)
+    else:
+        # The first rank reads every split for the vocabularies and token caches. With a token
+        # cache the other ranks read nothing, without one only the splits they train on, and
+        # local masters the test split they evaluate
+        rank = torch.distributed.get_rank()
+        local_master = int(os.environ["LOCAL_RANK"]) == 0
+        df_train = df_test = df_valid = None
+        if rank == 0 or not config.use_token_cache:
+            df_train = load_split(config.data_dir, "train")
+            df_valid = load_split(config.data_dir, "valid")
+        if rank == 0 or (local_master and not config.use_token_cache):
+            df_test = load_split(config.data_dir, "test")
 
-    tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos = create_tokenizer(df,config,
-                                                                           config.index_pool_size,config.momentum_pool_size)
+    # Only the first rank tokenizes the full corpus, the others receive its vocabularies
+    df = None
+    if torch.distributed.get_rank() == 0:
+        if config.stream_data:
+            df = StreamingCorpus(df_train.paths + df_valid.paths + df_test.paths, config.ingest_chunk_size)
+        else:
+            df = pd.concat([df_train,df_valid,df_test]).reset_index(drop=True)
+
+    tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos = create_shared_tokenizer(df,config,
+                                                                                  config.index_pool_size,config.momentum_pool_size)
+    del df
     config.src_voc_size = len(src_vocab)
     config.tgt_voc_size = len(tgt_vocab)    
     
     if config.debug:
         config.epochs = 1
+    if config.debug and not config.stream_data and df_train is not None:
         df_train = df_train.sample(1000).reset_index(drop=True)
     
-    print(f"TRAIN SAMPLES : {df_train.shape}")
+    if config.stream_data:
+        print(f"TRAIN DATA : {df_train}")
+    elif df_train is not None:
+        print(f"TRAIN SAMPLES : {df_train.shape}")
     print("Data loading complete")
 
     main(config,df_train,df_test,df_valid,tokenizer,src_vocab,tgt_vocab,tgt_itos)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import Transformer
 from torch import Tensor
 import math
@@ -28,8 +29,8 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.register_buffer('pos_embedding', pos_embedding)
 
-    def forward(self, token_embedding: Tensor):
-        return self.dropout(token_embedding + self.pos_embedding[:token_embedding.size(0), :])
+    def forward(self, token_embedding: Tensor, start: int = 0):
+        return self.dropout(token_embedding + self.pos_embedding[start:start + token_embedding.size(0), :])
 
 
 class TokenEmbedding(nn.Module):
@@ -148,3 +149,101 @@ class Model(nn.Module):
         """
         return self.transformer.decoder(self.positional_encoding(self.tgt_tok_emb(tgt)), memory, tgt_mask, memory_mask, tgt_pad_mask, memory_pad_mask)
 
+    def init_decoder_cache(self, beams: int = 1):
+        """
+        Per-layer key/value caches for incremental decoding with decode_step.
+
+        Args:
+            beams (int, optional): Consecutive target columns per memory column, which attend
+                to that memory column in common. Defaults to 1.
+
+        Returns:
+            list: One cache per decoder layer.
+        """
+        return [{'self': {}, 'cross': {}, 'beams': beams} for _ in self.transformer.decoder.layers]
+
+    def reorder_decoder_cache(self, cache, beam_idx: Tensor):
+        """Follow the surviving beams. Beams never leave their example, so only the self-attention caches move."""
+        for layer_cache in cache:
+            for name in ('key', 'value', 'pad_mask'):
+                layer_cache['self'][name] = layer_cache['self'][name].index_select(0, beam_idx)
+
+    def decode_step(self, tgt: Tensor, memory: Tensor, tgt_pad_mask: Tensor, memory_pad_mask: Tensor, cache):
+        """
+        Decode new target positions, attending to the previous ones through the cache.
+
+        Runs the same computation as decode with the weights of the nn.Transformer decoder
+        layers (post-norm), but projects the keys and values of every position and of the
+        memory only once.
+
+        Args:
+            tgt (Tensor): New target tokens of shape (new_len, batch * beams).
+            memory (Tensor): Encoder output of shape (src_len, batch, emb_size).
+            tgt_pad_mask (Tensor): Padding mask of the new target tokens of shape (batch * beams, new_len).
+            memory_pad_mask (Tensor): Padding mask of the memory of shape (batch, src_len).
+            cache (list): Caches from init_decoder_cache, updated in place.
+
+        Returns:
+            Tensor: Decoded tensor of shape (new_len, batch * beams, emb_size).
+        """
+        start = cache[0]['self']['key'].shape[2] if 'key' in cache[0]['self'] else 0
+        # Batch-first inside the step, (new_len, batch, emb_size) --> (batch, new_len, emb_size)
+        x = self.positional_encoding(self.tgt_tok_emb(tgt), start).transpose(0, 1)
+        memory = memory.transpose(0, 1)
+        memory_mask = ~memory_pad_mask.unsqueeze(1).unsqueeze(1)
+        for layer, layer_cache in zip(self.transformer.decoder.layers, cache):
+            self_cache = layer_cache['self']
+            self_cache['pad_mask'] = torch.cat([self_cache['pad_mask'], tgt_pad_mask], dim=1) if 'pad_mask' in self_cache else tgt_pad_mask
+            self_attention = _cached_attention(layer.self_attn, x, x, ~self_cache['pad_mask'].unsqueeze(1).unsqueeze(1), self_cache)
+            x = layer.norm1(x + layer.dropout1(self_attention))
+            cross_attention = _cached_attention(layer.multihead_attn, x, memory, memory_mask, layer_cache['cross'],
+                                                static_kv=True, beams=layer_cache['beams'])
+            x = layer.norm2(x + layer.dropout2(cross_attention))
+            x = layer.norm3(x + layer.dropout3(layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))))
+        if self.transformer.decoder.norm is not None:
+            x = self.transformer.decoder.norm(x)
+        return x.transpose(0, 1)
+
+
+def _cached_attention(attention: nn.MultiheadAttention, x: Tensor, kv: Tensor, mask, cache, static_kv: bool = False, beams: int = 1):
+    """
+    Attention of nn.MultiheadAttention weights over batch-first inputs, with a key/value cache.
+
+    Static keys and values (the memory) are projected on the first call and reused, the others
+    are appended to those of the previous calls. The boolean mask is True where attention is
+    allowed. With beams, the beams of a memory row are
+    folded into the query length, so that they attend to its keys and values without copies.
+    """
+    h = attention.num_heads
+    d_k = attention.embed_dim // h
+    w_q, w_k, w_v = attention.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attention.in_proj_bias.chunk(3)
+    # (batch, seq_len, emb_size) --> (batch, h, seq_len, d_k)
+    query = F.linear(x, w_q, b_q).view(x.shape[0], -1, h, d_k).transpose(1, 2)
+    if static_kv and 'key' in cache:
+        key, value = cache['key'], cache['value']
+    else:
+        key = F.linear(kv, w_k, b_k).view(kv.shape[0], -1, h, d_k).transpose(1, 2)
+        value = F.linear(kv, w_v, b_v).view(kv.shape[0], -1, h, d_k).transpose(1, 2)
+        if not static_kv and 'key' in cache:
+            key = torch.cat([cache['key'], key], dim=2)
+            value = torch.cat([cache['value'], value], dim=2)
+        cache['key'], cache['value'] = key, value
+
+    q_len = query.shape[2]
+    if not static_kv and q_len > 1:
+        # New positions see the cached ones and the new ones up to themselves
+        mask = mask & torch.ones(q_len, key.shape[2], dtype=torch.bool, device=x.device).tril(key.shape[2] - q_len)
+    assert query.shape[0] == beams * key.shape[0], \
+        f"{query.shape[0]} queries do not match {beams} beams of {key.shape[0]} keys"
+    if beams > 1:
+        # (batch * beams, h, q_len, d_k) --> (batch, h, beams * q_len, d_k)
+        query = query.view(key.shape[0], beams, h, q_len, d_k).transpose(1, 2).reshape(key.shape[0], h, beams * q_len, d_k)
+    out = F.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                         dropout_p=attention.dropout if attention.training else 0.0)
+    if beams > 1:
+        out = out.view(key.shape[0], h, beams, q_len, d_k).transpose(1, 2).reshape(-1, h, q_len, d_k)
+    # (batch, h, seq_len, d_k) --> (batch, seq_len, emb_size)
+    out = out.transpose(1, 2).reshape(out.shape[0], q_len, h * d_k)
+    return attention.out_proj(out)
+
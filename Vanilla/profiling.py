@@ -0,0 +1,171 @@
+import contextlib
+import os
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+import torch
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class StepProfiler:
+    """
+    Opt-in per-phase timing of training steps.
+
+    Every phase of a step records its host wall time with perf counters and, on CUDA,
+    its device time with a pair of CUDA events. Events are only resolved on logging
+    steps, so timing never adds a device synchronisation to ordinary steps. Rolling
+    percentiles over the last ``window`` steps are logged through ``run.log``.
+
+    Optionally a ``torch.profiler`` trace of the steps ``[trace_start, trace_start + trace_steps)``
+    is written to ``trace_dir``. With timing disabled ``phase`` returns a shared null
+    context, ``iterate`` returns the iterable itself and ``step`` only checks the trace window.
+
+    Args:
+        enabled (bool): Whether phase timing is active.
+        device (torch.device or int): Training device.
+        run (wandb.Run, optional): Run to log to, None on non-logging ranks.
+        log_freq (int, optional): Steps between logged summaries. Defaults to 50.
+        window (int, optional): Number of steps the percentiles are taken over. Defaults to 100.
+        trace_dir (str, optional): Directory of the torch.profiler trace. Defaults to None (no trace).
+        trace_start (int, optional): First traced global step, a run resumed past it traces its
+            first steps instead. Defaults to 10.
+        trace_steps (int, optional): Number of traced steps. Defaults to 5.
+        rank (int, optional): Rank used in the trace file name. Defaults to 0.
+    """
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, enabled, device, run=None, log_freq=50, window=100, trace_dir=None, trace_start=10,
+                 trace_steps=5, rank=0):
+        self.enabled = enabled
+        self.device = torch.device(device) if not isinstance(device, int) else torch.device('cuda', device)
+        self.use_events = enabled and self.device.type == 'cuda' and torch.cuda.is_available()
+        self.run = run
+        self.log_freq = log_freq
+        self.wall = defaultdict(lambda: deque(maxlen=window))
+        self.device_time = defaultdict(lambda: deque(maxlen=window))
+        self.pending = []
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.rank = rank
+        self.trace = None
+        self.trace_first = None
+
+    def phase(self, name):
+        """
+        Context manager timing one phase of the current step.
+
+        Args:
+            name (str): Name of the phase.
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        if self.use_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall[name].append(time.perf_counter() - start)
+            if self.use_events:
+                end_event.record()
+                self.pending.append((name, start_event, end_event))
+
+    def iterate(self, iterable, name='data'):
+        """
+        Iterate over a dataloader, timing how long every batch takes to arrive.
+
+        Args:
+            iterable (iterable): Dataloader or progress bar.
+            name (str, optional): Name of the phase. Defaults to 'data'.
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(iterable, name)
+
+    def _timed_iter(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wall[name].append(time.perf_counter() - start)
+            yield batch
+
+    def step(self, global_step):
+        """
+        Mark the end of a training step.
+
+        Args:
+            global_step (int): Global step that just finished.
+        """
+        if self.trace_dir is not None:
+            self._trace_step(global_step)
+        if self.enabled and global_step % self.log_freq == 0:
+            self._log(global_step)
+
+    def _trace_step(self, global_step):
+        next_step = global_step + 1
+        if self.trace_first is None and next_step >= self.trace_start:
+            # Start before the first traced step begins
+            self.trace_first = next_step
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.start()
+        elif self.trace is not None and next_step >= self.trace_first + self.trace_steps:
+            self.trace.stop()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, f"trace_rank{self.rank}_step{self.trace_first}.json")
+            self.trace.export_chrome_trace(path)
+            self.trace = None
+            print(f"Wrote profiler trace to {path}")
+
+    def _resolve_events(self):
+        if not self.pending:
+            return
+        # Waiting for the last event makes all earlier ones readable
+        self.pending[-1][2].synchronize()
+        for name, start_event, end_event in self.pending:
+            self.device_time[name].append(start_event.elapsed_time(end_event) / 1e3)
+        self.pending.clear()
+
+    def summary(self):
+        """
+        Rolling percentiles of every phase in milliseconds.
+
+        Returns:
+            dict: Metrics keyed by 'profile/<phase>_<wall|device>_p<q>_ms'.
+        """
+        self._resolve_events()
+        metrics = {}
+        for kind, times in (('wall', self.wall), ('device', self.device_time)):
+            for name, values in times.items():
+                if values:
+                    percentiles = np.percentile(np.asarray(values) * 1e3, self.PERCENTILES)
+                    for q, value in zip(self.PERCENTILES, percentiles):
+                        metrics[f"profile/{name}_{kind}_p{q}_ms"] = float(value)
+        return metrics
+
+    def _log(self, global_step):
+        metrics = self.summary()
+        if self.run is not None and metrics:
+            self.run.log({**metrics, 'global_step': global_step})
+
+    def close(self):
+        """Stop an unfinished trace."""
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
@@ -0,0 +1,143 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Distributed batch sampler that groups sequences of similar length.
+
+    Like DistributedSampler, every epoch is a permutation seeded by ``seed + epoch``
+    that is identical on all ranks, and each rank takes every ``num_replicas``-th batch
+    of it. The permutation is split into buckets of ``batch_size * bucket_size_multiplier``
+    samples, each bucket is sorted by length and cut into batches, and the batch order
+    is shuffled again so that lengths do not grow monotonically through the epoch.
+
+    With ``max_tokens`` the sorted buckets are instead packed into batches of at most
+    ``max_tokens`` padded source and target tokens, so batches of short sequences hold
+    more samples than batches of long ones.
+
+    Args:
+        lengths (array): Source and target length of every sample, of shape (num_samples, 2).
+        batch_size (int, optional): Number of samples per batch. Not used with max_tokens.
+        num_replicas (int, optional): Number of processes taking part in training. Defaults to 1.
+        rank (int, optional): Rank of the current process. Defaults to 0.
+        shuffle (bool, optional): Whether to shuffle samples and batches. Defaults to True.
+        bucket_size_multiplier (int, optional): Bucket size in batches. Defaults to 100.
+        seed (int, optional): Base seed of the shuffling. Defaults to 0.
+        max_tokens (int, optional): Token budget of a batch, counting padding. Defaults to None.
+    """
+
+    def __init__(self, lengths, batch_size=None, num_replicas=1, rank=0, shuffle=True,
+                 bucket_size_multiplier=100, seed=0, max_tokens=None):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("Either batch_size or max_tokens must be given")
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        if max_tokens is None:
+            self.bucket_size = batch_size * bucket_size_multiplier
+        else:
+            # Buckets span about bucket_size_multiplier batches of average length
+            mean_length = max(self.lengths.sum(axis=1).mean(), 1) if len(self.lengths) else 1
+            self.bucket_size = bucket_size_multiplier * max(int(max_tokens // mean_length), 1)
+        self.seed = seed
+        self.epoch = 0
+        # Batches of the current epoch, packing them is a pass over all samples
+        self._epoch_batches = None
+
+    def set_epoch(self, epoch):
+        """Set the epoch, so that every epoch uses a different ordering."""
+        if epoch != self.epoch:
+            self._epoch_batches = None
+        self.epoch = epoch
+
+    def _generator(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return generator
+
+    def _buckets(self, generator):
+        """Split a permutation of the samples into buckets sorted by length."""
+        num_samples = len(self.lengths)
+        if self.shuffle:
+            indices = torch.randperm(num_samples, generator=generator).numpy()
+        else:
+            indices = np.arange(num_samples)
+        for start in range(0, num_samples, self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            lengths = self.lengths[bucket]
+            yield bucket[np.lexsort((lengths[:, 1], lengths[:, 0]))]
+
+    def _split(self, bucket):
+        """Cut a sorted bucket into batches."""
+        if self.max_tokens is None:
+            return [bucket[start:start + self.batch_size].tolist() for start in range(0, len(bucket), self.batch_size)]
+
+        batches, batch = [], []
+        max_src = max_tgt = 0
+        for idx, (src_len, tgt_len) in zip(bucket.tolist(), self.lengths[bucket].tolist()):
+            new_src, new_tgt = max(max_src, src_len), max(max_tgt, tgt_len)
+            # A sample longer than the budget still gets a batch of its own
+            if batch and (len(batch) + 1) * (new_src + new_tgt) > self.max_tokens:
+                batches.append(batch)
+                batch, new_src, new_tgt = [], src_len, tgt_len
+            batch.append(idx)
+            max_src, max_tgt = new_src, new_tgt
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self):
+        """
+        Batches of the current epoch for this rank, computed once per epoch.
+
+        Returns:
+            list: Lists of sample indices.
+        """
+        if self._epoch_batches is None:
+            self._epoch_batches = self._batches(self.epoch)
+        return self._epoch_batches
+
+    def epoch_lengths(self, epochs):
+        """
+        Number of batches of this rank in each of the given epochs.
+
+        With max_tokens this packs every epoch once, without keeping its batches.
+
+        Args:
+            epochs (iterable): Epochs to count.
+
+        Returns:
+            list: Number of batches per epoch.
+        """
+        if self.max_tokens is None:
+            return [len(self) for _ in epochs]
+        return [len(self.batches()) if epoch == self.epoch else len(self._batches(epoch)) for epoch in epochs]
+
+    def _batches(self, epoch):
+        """Batches of an epoch for this rank."""
+        generator = self._generator(epoch)
+        batches = [batch for bucket in self._buckets(generator) for batch in self._split(bucket)]
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        # Repeat batches from the start so that every rank gets the same number of steps
+        padding = -len(batches) % self.num_replicas
+        batches += (batches * math.ceil(padding / max(len(batches), 1)))[:padding]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        if self.max_tokens is not None:
+            # The number of packed batches depends on the epoch's permutation
+            return len(self.batches())
+        return math.ceil(math.ceil(len(self.lengths) / self.batch_size) / self.num_replicas)
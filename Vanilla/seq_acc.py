@@ -1,6 +1,7 @@
 from trainer import sequence_accuracy
 from fn_utils import create_tokenizer, parse_args, create_config_from_args, init_distributed_mode
 from data import Data
+from ingest import load_split
 import pandas as pd
 import numpy as np
 import os
@@ -20,16 +21,16 @@ local_rank = int(os.environ["LOCAL_RANK"])
 print(config)
 
 # Read train, test, and validation data
-df_train = pd.read_csv(config.data_dir + "train.csv")
-df_test = pd.read_csv(config.data_dir + "test.csv")
-df_valid = pd.read_csv(config.data_dir + "valid.csv")
+df_train = load_split(config.data_dir, "train")
+df_test = load_split(config.data_dir, "test")
+df_valid = load_split(config.data_dir, "valid")
 
 # Concatenate dataframes for tokenization purposes
 df = pd.concat([df_train, df_valid, df_test]).reset_index(drop=True)
 
 # Create tokenizer and vocabularies
 tokenizer, src_vocab, tgt_vocab, src_itos, tgt_itos = create_tokenizer(
-    df, config, config.index_pool_size, config.momentum_pool_size, is_old=False,
+    df, config, config.index_pool_size, config.momentum_pool_size,
 )
 config.src_voc_size = len(src_vocab)
 config.tgt_voc_size = len(tgt_vocab)
@@ -0,0 +1,134 @@
+import math
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+
+class ShardedData(IterableDataset):
+    """
+    Iterable dataset of batches read from a token cache split into shards.
+
+    The cache is split into shards of ``shard_size`` consecutive samples. Every epoch the
+    shard order is shuffled with ``seed`` and the epoch, identically on all ranks, and cut
+    into ``num_replicas * num_workers`` equal contiguous parts, one per (rank, worker) pair,
+    so that a rank only ever reads its own slice of the cache. The few samples left over by
+    the cut are skipped for that epoch. Each pair passes its samples through a shuffle buffer
+    of ``shuffle_buffer`` samples and cuts them into batches.
+
+    Every pair yields the same number of batches, so all ranks take the same number of
+    steps. The DataLoader takes batches from its workers in turn, which makes the batch
+    order of a rank depend on the epoch only, and ``set_epoch`` can resume it after any
+    number of consumed samples without reading them.
+
+    Args:
+        data (Data): Dataset backed by a token cache, producing the samples.
+        batch_size (int): Number of samples per batch.
+        collate_fn (callable, optional): Merges samples into a batch. Defaults to default_collate.
+        num_replicas (int, optional): Number of processes taking part in training. Defaults to 1.
+        rank (int, optional): Global rank of the current process. Defaults to 0.
+        num_workers (int, optional): DataLoader worker processes, 0 counts as one. Defaults to 0.
+        shuffle (bool, optional): Whether to shuffle shards and samples. Defaults to True.
+        shard_size (int, optional): Number of samples per shard. Defaults to 10000.
+        shuffle_buffer (int, optional): Number of samples in the shuffle buffer. Defaults to 10000.
+        seed (int, optional): Base seed of the shuffling. Defaults to 0.
+    """
+
+    def __init__(self, data, batch_size, collate_fn=default_collate, num_replicas=1, rank=0, num_workers=0,
+                 shuffle=True, shard_size=10000, shuffle_buffer=10000, seed=0):
+        super().__init__()
+        if data.token_cache is None:
+            raise ValueError("ShardedData reads pre-tokenised shards, the dataset needs a token cache")
+        self.data = data
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_workers = max(num_workers, 1)
+        self.shuffle = shuffle
+        self.shard_size = shard_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+
+        self.num_samples = len(data)
+        self.part_size = self.num_samples // (num_replicas * self.num_workers)
+        if self.part_size == 0:
+            raise ValueError(f"{self.num_samples} samples cannot be split across "
+                             f"{num_replicas * self.num_workers} (rank, worker) pairs")
+        self.part_batches = math.ceil(self.part_size / batch_size)
+        self.epoch = 0
+        self.start_batch = 0
+
+    def __len__(self):
+        """Number of batches of the rank left in the epoch."""
+        return self.part_batches * self.num_workers - self.start_batch
+
+    def set_epoch(self, epoch, sample_offset=0):
+        """
+        Set the epoch, and the number of its samples the rank has already consumed.
+
+        Args:
+            epoch (int): Epoch to iterate.
+            sample_offset (int, optional): Samples to skip, at a batch boundary. Defaults to 0.
+        """
+        self.epoch = epoch
+        # All batches are full except the last one of every worker, which come last
+        full_batches = self.part_size // self.batch_size
+        full_samples = full_batches * self.num_workers * self.batch_size
+        if sample_offset <= full_samples:
+            start_batch = sample_offset // self.batch_size
+        else:
+            last_size = self.part_size - full_batches * self.batch_size
+            start_batch = full_batches * self.num_workers + (sample_offset - full_samples) // last_size
+        self.start_batch = min(start_batch, self.part_batches * self.num_workers)
+
+    def _part_indices(self, part):
+        """Sample indices of a (rank, worker) part of the epoch, in shard order."""
+        num_shards = math.ceil(self.num_samples / self.shard_size)
+        shards = np.arange(num_shards)
+        if self.shuffle:
+            shards = np.random.default_rng((self.seed, self.epoch)).permutation(num_shards)
+        starts = shards * self.shard_size
+        sizes = np.minimum(starts + self.shard_size, self.num_samples) - starts
+        ends = np.cumsum(sizes)
+
+        # Only the shards overlapping the part are expanded to indices
+        begin = part * self.part_size
+        first = np.searchsorted(ends, begin, side='right')
+        last = np.searchsorted(ends, begin + self.part_size - 1, side='right')
+        indices = np.concatenate([np.arange(starts[i], starts[i] + sizes[i]) for i in range(first, last + 1)])
+        offset = begin - (ends[first] - sizes[first])
+        return indices[offset:offset + self.part_size]
+
+    def _shuffle_buffer(self, indices, part):
+        """Emit each index drawn at random from a buffer, which the next index then refills."""
+        size = min(self.shuffle_buffer, len(indices))
+        if not self.shuffle or size <= 1:
+            return indices
+        generator = np.random.default_rng((self.seed, self.epoch, part))
+        order = np.empty_like(indices)
+        buffer = indices[:size].copy()
+        picks = generator.integers(0, size, len(indices) - size)
+        for i, (pick, index) in enumerate(zip(picks.tolist(), indices[size:].tolist())):
+            order[i] = buffer[pick]
+            buffer[pick] = index
+        order[len(indices) - size:] = generator.permutation(buffer)
+        return order
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker = 0
+        if worker_info is not None:
+            if worker_info.num_workers != self.num_workers:
+                raise ValueError(f"ShardedData was set up for {self.num_workers} workers, "
+                                 f"the DataLoader runs {worker_info.num_workers}")
+            worker = worker_info.id
+
+        # Batch b of the epoch is batch b // num_workers of part b % num_workers. After a resume the
+        # DataLoader starts again at worker 0, so each worker keeps to a single part all the same.
+        first_batch = self.start_batch + worker
+        part = self.rank * self.num_workers + first_batch % self.num_workers
+        order = self._shuffle_buffer(self._part_indices(part), part)
+        for batch in range(first_batch // self.num_workers, self.part_batches):
+            indices = order[batch * self.batch_size:(batch + 1) * self.batch_size]
+            yield self.collate_fn([self.data[idx] for idx in indices.tolist()])
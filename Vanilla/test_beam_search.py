@@ -0,0 +1,41 @@
+import math
+
+import pytest
+import torch
+
+from beam_search import BeamSearch
+from constants import BOS_IDX, EOS_IDX
+
+VOCAB_SIZE = 8
+TOKEN_A, TOKEN_B = 5, 6
+
+
+def step_fn(ys):
+    """Log-probabilities that depend on the prefix length only."""
+    log_probs = torch.full((ys.size(0), VOCAB_SIZE), -20.0)
+    if ys.size(1) == 1:
+        # A continues ahead of an immediate EOS
+        log_probs[:, TOKEN_A], log_probs[:, EOS_IDX], log_probs[:, TOKEN_B] = math.log(0.6), math.log(0.4), -5.0
+    elif ys.size(1) == 2:
+        # The continuations of A outscore the finished hypothesis once normalised by length
+        log_probs[:, TOKEN_A], log_probs[:, TOKEN_B] = -0.01, -0.02
+    else:
+        # Every longer continuation is unlikely
+        log_probs[:, EOS_IDX], log_probs[:, TOKEN_A] = -10.0, -12.0
+    return log_probs
+
+
+@pytest.mark.parametrize('early_stopping', [True, False])
+def test_displaced_finished_hypothesis_is_kept(early_stopping):
+    # After the second step [A, A] and [A, B] fill both beams and push out [EOS], which
+    # remains the best hypothesis: log(0.4) / 1 against about -10.5 / 3 for [A, A, EOS]
+    search = BeamSearch(beam_width=2, max_len=6, length_penalty=1.0, early_stopping=early_stopping)
+    sequences = search.search(step_fn, batch_size=3, start_symbol=BOS_IDX, device='cpu')
+    assert sequences == [[BOS_IDX, EOS_IDX]] * 3
+
+
+def test_unfinished_examples_return_their_best_live_beam():
+    search = BeamSearch(beam_width=2, max_len=3)
+    sequences = search.search(lambda ys: step_fn(ys).index_fill(1, torch.tensor([EOS_IDX]), -50.0),
+                              batch_size=1, start_symbol=BOS_IDX, device='cpu')
+    assert sequences == [[BOS_IDX, TOKEN_A, TOKEN_A]]
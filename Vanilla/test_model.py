@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from constants import BOS_IDX, PAD_IDX
+from fn_utils import create_mask, generate_eqn_mask
+from model import Model
+
+
+def test_decode_step_matches_decode():
+    torch.manual_seed(0)
+    model = Model(2, 2, 32, 4, 20, 20, 64, 0.0).double().eval()
+    src = torch.randint(3, 20, (12, 3))
+    src[8:, 0] = PAD_IDX
+    src_mask, _, src_padding_mask, _ = create_mask(src, torch.full((1, 3), BOS_IDX), 'cpu')
+    memory = model.encode(src, src_mask, src_padding_mask)
+    beams = 4
+    example_idx = torch.arange(3).repeat_interleave(beams)
+    tgt = torch.randint(3, 20, (6, 3 * beams))
+    tgt[0] = BOS_IDX
+    # A padded position, which the following ones must not attend to
+    tgt[3, 1] = PAD_IDX
+    tgt_padding_mask = (tgt == PAD_IDX).transpose(0, 1)
+    full = model.decode(tgt, memory[:, example_idx], generate_eqn_mask(tgt.size(0), 'cpu').bool(), None,
+                        tgt_padding_mask, src_padding_mask[example_idx])
+
+    # One position at a time, the memory shared by the beams of an example
+    cache = model.init_decoder_cache(beams=beams)
+    steps = [model.decode_step(tgt[i:i + 1], memory, tgt_padding_mask[:, i:i + 1], src_padding_mask, cache)
+             for i in range(tgt.size(0))]
+    torch.testing.assert_close(torch.cat(steps), full)
+
+    # The whole prefix at once
+    cache = model.init_decoder_cache(beams=beams)
+    torch.testing.assert_close(model.decode_step(tgt, memory, tgt_padding_mask, src_padding_mask, cache), full)
+
+    with pytest.raises(AssertionError):
+        model.decode_step(tgt[:1], memory, tgt_padding_mask[:, :1], src_padding_mask, model.init_decoder_cache(beams=3))
@@ -0,0 +1,34 @@
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+from bench_tokenizer import reference_src_tokenize, reference_tgt_tokenize
+from constants import SPECIAL_SYMBOLS, UNK_IDX
+from tokenizer import Tokenizer
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Data', '*.csv')
+SEED = 42
+
+
+@pytest.fixture(scope='module')
+def expressions():
+    paths = sorted(glob.glob(DATA))
+    assert paths, f"No CSV files match {DATA}"
+    df = pd.concat([pd.read_csv(path, usecols=['amp', 'sqamp']) for path in paths], ignore_index=True)
+    return df.amp.tolist(), df.sqamp.tolist()
+
+
+@pytest.mark.parametrize('to_replace', [False, True])
+@pytest.mark.parametrize('memo_size', [0, 100_000])
+def test_tokenizer_matches_reference(expressions, to_replace, memo_size):
+    amps, sqamps = expressions
+    tokenizer = Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, to_replace, memo_size=memo_size)
+    reference = Tokenizer(None, 100, 100, SPECIAL_SYMBOLS, UNK_IDX, to_replace)
+    # Two passes, so that the memoised tokenizer is also checked on its hits
+    for _ in range(2):
+        for amp in amps:
+            assert tokenizer.src_tokenize(amp, SEED) == reference_src_tokenize(reference, amp, SEED), amp
+        for sqamp in sqamps:
+            assert tokenizer.tgt_tokenize(sqamp) == reference_tgt_tokenize(reference, sqamp), sqamp
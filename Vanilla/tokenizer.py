@@ -1,18 +1,51 @@
-from collections import Counter, OrderedDict
-from itertools import cycle
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import math
+import os
 import re
 import random
+import sys
 from torchtext.vocab import vocab
 from tqdm import tqdm
 import warnings
 
+# Smallest number of expressions worth sending to a worker process
+MIN_SHARD_SIZE = 1000
+# Version of the tokenization, part of the token cache keys. Bump it whenever the tokens
+# produced for an expression change. 2: single-pass splitters and src_replace rewrite
+TOKENIZER_VERSION = 2
+
+def _count_tokens(tokenize, expressions, args=(), desc=None):
+    """Count the tokens of a list of expressions."""
+    counter = Counter()
+    for expression in tqdm(expressions, desc=desc, disable=desc is None):
+        counter.update(tokenize(expression, *args))
+    return counter
+
+def _count_chunk_tokens(tokenizer, amps, sqamps, seed):
+    """Count the source and target tokens of one chunk of expression pairs."""
+    return (_count_tokens(tokenizer.src_tokenize, amps, (seed,)),
+            _count_tokens(tokenizer.tgt_tokenize, sqamps))
+
+def _num_workers(workers):
+    """Number of worker processes, 0 uses every available core."""
+    if workers <= 0:
+        workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return workers
+
 class Tokenizer:
     """
     Tokenizer for processing symbolic mathematical expressions.
+
+    Token lists are memoised per raw expression (and seed, when replacing indices) in bounded
+    LRU caches of ``memo_size`` entries each, 0 disables them.
     """
-    def __init__(self, df, index_token_pool_size, momentum_token_pool_size, special_symbols, UNK_IDX, to_replace):
-        self.amps = df.amp.tolist()
-        self.sqamps = df.sqamp.tolist()
+    def __init__(self, df, index_token_pool_size, momentum_token_pool_size, special_symbols, UNK_IDX, to_replace,
+                 memo_size=16384):
+        # Without a DataFrame the tokenizer can only tokenize, not build vocabularies
+        self.amps = df.amp.tolist() if df is not None else []
+        self.sqamps = df.sqamp.tolist() if df is not None else []
 
         # Issue warnings if token pool sizes are too small
         if index_token_pool_size < 100:
@@ -28,25 +61,39 @@ class Tokenizer:
         self.pattern_momentum = re.compile(r'\b[ijkl]_\d{1,}\b')
         self.pattern_num_123 = re.compile(r'\b(?![ps]_)\w+_\d{1,}\b')
         self.pattern_special = re.compile(r'\b\w+_+\w+\b\\')
-        self.pattern_underscore_curly = re.compile(r'\b\w+_{')
         self.pattern_prop = re.compile(r'Prop')
         self.pattern_int = re.compile(r'int\{')
-        self.pattern_operators = {
-            '+': re.compile(r'\+'), '-': re.compile(r'-'), '*': re.compile(r'\*'),
-            ',': re.compile(r','), '^': re.compile(r'\^'), '%': re.compile(r'%'),
-            '}': re.compile(r'\}'), '(': re.compile(r'\('), ')': re.compile(r'\)')
-        }
-        self.pattern_mass = re.compile(r'\b\w+_\w\b')
-        self.pattern_s = re.compile(r'\b\w+_\d{2,}\b')
-        self.pattern_reg_prop = re.compile(r'\b\w+_\d{1}\b')
         self.pattern_antipart = re.compile(r'(\w)_\w+_\d+\(X\)\^\(\*\)')
         self.pattern_part = re.compile(r'(\w)_\w+_\d+\(X\)')
         self.pattern_index = re.compile(r'\b\w+_\w+_\d{2,}\b')
-        
+        # All three replacements in one pass, a name takes the first alternative it matches
+        self.pattern_replace = re.compile(
+            f"(?P<momentum>{self.pattern_momentum.pattern})|(?P<num_123>{self.pattern_num_123.pattern})"
+            f"|(?P<index>{self.pattern_index.pattern})")
+        # Shuffled token pools per replacement seed
+        self.replacement_pools = {}
+
+        # Single-pass splitters, the captured separators are tokens of their own:
+        # source: operators, backslashes and words ending in '_{', split at spaces
+        self.pattern_src_split = re.compile(r' |(\\|[-+*,^}()]|\b\w+_{)')
+        # target: operators and words ending in '_' followed by one character or 2+ digits
+        self.pattern_tgt_split = re.compile(r'([-+*,^%}()]|\b\w+_(?:\w|\d{2,})\b)')
+
         self.special_symbols = special_symbols
         self.UNK_IDX = UNK_IDX
         self.to_replace = to_replace
 
+        self.memo_size = memo_size
+        self.src_memo = OrderedDict()
+        self.tgt_memo = OrderedDict()
+
+    def __getstate__(self):
+        # Worker processes only tokenize, they need neither the corpus nor the memos
+        state = self.__dict__.copy()
+        state['amps'], state['sqamps'] = [], []
+        state['src_memo'], state['tgt_memo'] = OrderedDict(), OrderedDict()
+        return state
+
     @staticmethod
     def remove_whitespace(expression):
         """Remove all forms of whitespace from the expression."""
@@ -57,76 +104,159 @@ class Tokenizer:
         """Split the expression by space delimiter."""
         return re.split(r' ', expression)
 
-    def build_tgt_vocab(self):
-        """Build vocabulary for target sequences."""
+    @staticmethod
+    def count_tokens(tokenize, expressions, args=(), workers=0, desc=None):
+        """
+        Count tokens, sharding the expressions across worker processes.
+
+        Shard counters are merged in shard order, so tokens keep the order of their first
+        occurrence in the corpus and vocabulary indices match a serial count.
+
+        Args:
+            tokenize (callable): Tokenizing method, pickled to the workers.
+            expressions (list): Expressions to tokenize.
+            args (tuple, optional): Further arguments of tokenize. Defaults to ().
+            workers (int, optional): Number of processes, 0 uses every available core. Defaults to 0.
+            desc (str, optional): Progress bar description. Defaults to None.
+        """
+        workers = min(_num_workers(workers), len(expressions) // MIN_SHARD_SIZE)
+        if workers <= 1:
+            return _count_tokens(tokenize, expressions, args, desc)
+
+        # A few shards per worker even out shards of slower expressions
+        num_shards = min(4 * workers, len(expressions) // MIN_SHARD_SIZE)
+        shard_size = math.ceil(len(expressions) / num_shards)
+        shards = [expressions[start:start + shard_size] for start in range(0, len(expressions), shard_size)]
         counter = Counter()
-        for eqn in tqdm(self.sqamps, desc='Processing target vocab'):
-            counter.update(self.tgt_tokenize(eqn))
+        with ProcessPoolExecutor(workers) as executor:
+            results = executor.map(_count_tokens, repeat(tokenize), shards, repeat(args))
+            for shard_counter in tqdm(results, total=len(shards), desc=desc, disable=desc is None):
+                counter.update(shard_counter)
+        return counter
+
+    def count_chunk_tokens(self, chunks, seed, workers=0):
+        """
+        Count source and target tokens of a stream of DataFrame chunks.
+
+        Chunks are handed to the worker processes as they are read, with at most two per
+        worker in flight, and merged in chunk order like the shards of ``count_tokens``.
+
+        Args:
+            chunks (iterable): DataFrames with 'amp' and 'sqamp' columns.
+            seed (int): Seed used for source token replacement.
+            workers (int, optional): Number of processes, 0 uses every available core. Defaults to 0.
+
+        Returns:
+            tuple: Source and target token counters.
+        """
+        src_counter, tgt_counter = Counter(), Counter()
+
+        def merge(counters):
+            src_counter.update(counters[0])
+            tgt_counter.update(counters[1])
+
+        chunks = tqdm(chunks, desc='Processing vocabs', unit='chunk')
+        workers = _num_workers(workers)
+        if workers <= 1:
+            for chunk in chunks:
+                merge(_count_chunk_tokens(self, chunk.amp.tolist(), chunk.sqamp.tolist(), seed))
+            return src_counter, tgt_counter
+
+        pending = deque()
+        with ProcessPoolExecutor(workers) as executor:
+            for chunk in chunks:
+                pending.append(executor.submit(_count_chunk_tokens, self, chunk.amp.tolist(), chunk.sqamp.tolist(), seed))
+                if len(pending) >= 2 * workers:
+                    merge(pending.popleft().result())
+            while pending:
+                merge(pending.popleft().result())
+        return src_counter, tgt_counter
+
+    def vocab_from_counter(self, counter):
+        """Build a vocabulary of the counted tokens, in order of first occurrence."""
         voc = vocab(OrderedDict(counter), specials=self.special_symbols[:], special_first=True)
         voc.set_default_index(self.UNK_IDX)
         return voc
 
-    def build_src_vocab(self, seed):
+    def build_tgt_vocab(self, workers=0):
+        """Build vocabulary for target sequences."""
+        counter = self.count_tokens(self.tgt_tokenize, self.sqamps, workers=workers, desc='Processing target vocab')
+        return self.vocab_from_counter(counter)
+
+    def build_src_vocab(self, seed, workers=0):
         """Build vocabulary for source sequences."""
-        counter = Counter()
-        for diag in tqdm(self.amps, desc='Processing source vocab'):
-            counter.update(self.src_tokenize(diag, seed))
-        voc = vocab(OrderedDict(counter), specials=self.special_symbols[:], special_first=True)
-        voc.set_default_index(self.UNK_IDX)
-        return voc
+        counter = self.count_tokens(self.src_tokenize, self.amps, (seed,), workers, 'Processing source vocab')
+        return self.vocab_from_counter(counter)
     
+    def get_replacement_pools(self, seed):
+        """Index and momentum token pools shuffled by a private generator seeded with seed."""
+        pools = self.replacement_pools.get(seed)
+        if pools is None:
+            rng = random.Random(seed)
+            pools = (rng.sample(self.tokens_pool, len(self.tokens_pool)),
+                     rng.sample(self.momentum_pool, len(self.momentum_pool)))
+            self.replacement_pools[seed] = pools
+        return pools
+
     def src_replace(self, ampl, seed):
-        """Replace indexed and momentum variables with tokenized equivalents."""
+        """
+        Replace indexed and momentum variables with tokenized equivalents.
+
+        Names are assigned the next token of their shuffled pool in order of first occurrence,
+        the pools wrap around once exhausted.
+        """
         ampl = self.remove_whitespace(ampl)
-        
-        random.seed(seed)
-        token_cycle = cycle(random.sample(self.tokens_pool, len(self.tokens_pool)))
-        momentum_cycle = cycle(random.sample(self.momentum_pool, len(self.momentum_pool)))
-        
-        # Replace momentum tokens
-        temp_ampl = ampl
-        momentum_mapping = {match: next(momentum_cycle) for match in set(self.pattern_momentum.findall(ampl))}
-        for key, value in momentum_mapping.items():
-            temp_ampl = temp_ampl.replace(key, value)
-        
-        # Replace index tokens
-        num_123_mapping = {match: next(token_cycle) for match in set(self.pattern_num_123.findall(ampl))}
-        for key, value in num_123_mapping.items():
-            temp_ampl = temp_ampl.replace(key, value)
-
-        # Replace pattern index tokens
-        pattern_index_mapping = {match: f"{'_'.join(match.split('_')[:-1])} {next(token_cycle)}"
-                for match in set(self.pattern_index.findall(ampl))
-            }
-        for key, value in pattern_index_mapping.items():
-            temp_ampl = temp_ampl.replace(key, value)
-            
-        return temp_ampl
+        token_pool, momentum_pool = self.get_replacement_pools(seed)
+        mapping = {}
+        used = {'token': 0, 'momentum': 0}
+
+        def replace(match):
+            name = match.group(0)
+            if name not in mapping:
+                if match.lastgroup == 'momentum':
+                    mapping[name] = momentum_pool[used['momentum'] % len(momentum_pool)]
+                    used['momentum'] += 1
+                else:
+                    token = token_pool[used['token'] % len(token_pool)]
+                    used['token'] += 1
+                    # Pattern indices keep their prefix, e.g. 'gamma_mu_12' -> 'gamma_mu INDEX_3'
+                    mapping[name] = token if match.lastgroup == 'num_123' else f"{name.rsplit('_', 1)[0]} {token}"
+            return mapping[name]
+
+        return self.pattern_replace.sub(replace, ampl)
     
-    def src_tokenize(self, ampl, seed):
-        """Tokenize source expression, optionally applying replacements."""
-        temp_ampl = self.src_replace(ampl, seed) if self.to_replace else ampl
-        temp_ampl = temp_ampl.replace('\\\\', '\\').replace('\\', ' \\ ').replace('%', '')
+    def _memoize(self, memo, key, tokens):
+        memo[key] = tokens
+        if len(memo) > self.memo_size:
+            memo.popitem(last=False)
 
-        temp_ampl = self.pattern_underscore_curly.sub(lambda match: f' {match.group(0)} ', temp_ampl)
+    def _src_tokenize(self, ampl, seed):
+        temp_ampl = self.src_replace(ampl, seed) if self.to_replace else ampl
+        # '%' is dropped after collapsing double backslashes, as it may sit between two of them
+        temp_ampl = temp_ampl.replace('\\\\', '\\').replace('%', '')
+        # Interned tokens keep memoised token lists small
+        return tuple(map(sys.intern, filter(None, self.pattern_src_split.split(temp_ampl))))
 
-        
-        for symbol, pattern in self.pattern_operators.items():
-            temp_ampl = pattern.sub(f' {symbol} ', temp_ampl)
-        
-        temp_ampl = re.sub(r' {2,}', ' ', temp_ampl)
-        return [token for token in self.split_expression(temp_ampl) if token]
+    def src_tokenize(self, ampl, seed):
+        """Tokenize source expression, optionally applying replacements."""
+        key = (ampl, seed) if self.to_replace else ampl
+        tokens = self.src_memo.get(key)
+        if tokens is None:
+            tokens = self._src_tokenize(ampl, seed)
+            if self.memo_size:
+                self._memoize(self.src_memo, key, tokens)
+        else:
+            self.src_memo.move_to_end(key)
+        return list(tokens)
 
     def tgt_tokenize(self, sqampl):
         """Tokenize target expression."""
-        sqampl = self.remove_whitespace(sqampl)
-        temp_sqampl = sqampl
-        
-        for symbol, pattern in self.pattern_operators.items():
-            temp_sqampl = pattern.sub(f' {symbol} ', temp_sqampl)
-        
-        for pattern in [self.pattern_reg_prop, self.pattern_mass, self.pattern_s]:
-            temp_sqampl = pattern.sub(lambda match: f' {match.group(0)} ', temp_sqampl)
-        
-        temp_sqampl = re.sub(r' {2,}', ' ', temp_sqampl)
-        return [token for token in self.split_expression(temp_sqampl) if token]
\ No newline at end of file
+        tokens = self.tgt_memo.get(sqampl)
+        if tokens is None:
+            temp_sqampl = self.remove_whitespace(sqampl)
+            tokens = tuple(map(sys.intern, filter(None, self.pattern_tgt_split.split(temp_sqampl))))
+            if self.memo_size:
+                self._memoize(self.tgt_memo, sqampl, tokens)
+        else:
+            self.tgt_memo.move_to_end(sqampl)
+        return list(tokens)
\ No newline at end of file